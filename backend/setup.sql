@@ -29,9 +29,13 @@ CREATE TABLE IF NOT EXISTS refresh_tokens (
 CREATE TABLE IF NOT EXISTS data_v1 (
     id SERIAL PRIMARY KEY,
     data TEXT NOT NULL,
+    rule_version TEXT,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Rule set version of each record, added after the first release
+ALTER TABLE data_v1 ADD COLUMN IF NOT EXISTS rule_version TEXT;
+
 -- Create indexes for better performance
 CREATE INDEX IF NOT EXISTS idx_refresh_tokens_user_id ON refresh_tokens(user_id);
 CREATE INDEX IF NOT EXISTS idx_refresh_tokens_session_id ON refresh_tokens(session_id);
@@ -12,8 +12,10 @@ const createTableQueries = [
     `CREATE TABLE IF NOT EXISTS data_v1 (
         id SERIAL PRIMARY KEY,
         data TEXT NOT NULL,
+        rule_version TEXT,
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     );`,
+    `ALTER TABLE data_v1 ADD COLUMN IF NOT EXISTS rule_version TEXT;`,
     `CREATE TABLE IF NOT EXISTS users (
         id SERIAL PRIMARY KEY,
         username TEXT UNIQUE NOT NULL,
@@ -36,7 +38,10 @@ const connect = async () => {
         const res = await pool.query('SELECT NOW()');
         console.log('Connect PostgreSQL success!', res.rows[0].now);
 
-        await Promise.all(createTableQueries.map(query => pool.query(query)));
+        // In order, the ALTER needs data_v1 to exist
+        for (const query of createTableQueries) {
+            await pool.query(query);
+        }
         console.log('All tables created or verified successfully!');
     } catch (err) {
         console.error('Database connection or table creation error:', err);
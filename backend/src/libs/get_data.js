@@ -16,11 +16,15 @@ const formatted = `${yyyy}-${mm}-${dd}`;
 const file_path = `${path.join(__dirname, data_path)}/${formatted}.txt`;
 
 
-const insertData = async (text) => {
+// Records are written as "<data>\t<rule set version>", older files have no version
+const insertData = async (line) => {
+    const tab = line.lastIndexOf('\t');
+    const text = tab === -1 ? line : line.slice(0, tab);
+    const ruleVersion = tab === -1 ? null : line.slice(tab + 1);
     const query = `
-        INSERT INTO data_v1 (data) VALUES ($1);
+        INSERT INTO data_v1 (data, rule_version) VALUES ($1, $2);
     `;
-    await pool.query(query, [text]);
+    await pool.query(query, [text, ruleVersion]);
 }
 
 const reader = () => {
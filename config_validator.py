@@ -19,11 +19,13 @@ class ConfigValidator:
         'DIST': ['DIST_DIR'],
         'EXTRACT': ['EXTRACT_DIR'],
         'WHITELIST': ['WHITELIST_FILE_TYPES'],
-        'RULES': ['DATA_RULES'],
-        'TELE_API_1': ['APP_ID', 'HASH_ID', 'PHONE', 'USERNAME'],
-        'TELE_API_2': ['APP_ID', 'HASH_ID', 'PHONE', 'USERNAME']
+        'RULES': ['DATA_RULES']
     }
 
+    # Any number of [TELE_API_*] sections, at least one
+    API_SECTION_PREFIX = 'TELE_API_'
+    API_KEYS = ['APP_ID', 'HASH_ID', 'PHONE', 'USERNAME']
+
     OPTIONAL_SECTIONS = ['ELASTIC_API', 'MONGO_API']
 
     def __init__(self, config_path: str = 'config.ini'):
@@ -88,23 +90,40 @@ class ConfigValidator:
                     except Exception as e:
                         self.warnings.append(f'Cannot create directory {path}: {e}')
 
+    def _api_sections(self) -> List[str]:
+        """Telegram account sections present in the config"""
+        return [section for section in self.config.sections() if section.startswith(self.API_SECTION_PREFIX)]
+
     def _validate_api_credentials(self):
         """Validate Telegram API credentials"""
-        for api_section in ['TELE_API_1', 'TELE_API_2']:
-            if self.config.has_section(api_section):
-                app_id = self.config.get(api_section, 'APP_ID', fallback='')
-                hash_id = self.config.get(api_section, 'HASH_ID', fallback='')
-                phone = self.config.get(api_section, 'PHONE', fallback='')
-
-                # Basic validation
-                if not app_id.isdigit():
-                    self.errors.append(f'Invalid APP_ID in [{api_section}]: must be numeric')
-
-                if len(hash_id) != 32:
-                    self.errors.append(f'Invalid HASH_ID in [{api_section}]: must be 32 characters')
-
-                if not phone.startswith('+'):
-                    self.warnings.append(f'Phone number in [{api_section}] should start with +')
+        api_sections = self._api_sections()
+        if not api_sections:
+            self.errors.append(f'Missing required section: [{self.API_SECTION_PREFIX}1]')
+
+        usernames = set()
+        for api_section in api_sections:
+            for key in self.API_KEYS:
+                if not self.config.get(api_section, key, fallback='').strip():
+                    self.errors.append(f'Missing required key: [{api_section}]{key}')
+
+            username = self.config.get(api_section, 'USERNAME', fallback='')
+            if username in usernames:
+                self.errors.append(f'Duplicate USERNAME in [{api_section}]: sessions would collide')
+            usernames.add(username)
+
+            app_id = self.config.get(api_section, 'APP_ID', fallback='')
+            hash_id = self.config.get(api_section, 'HASH_ID', fallback='')
+            phone = self.config.get(api_section, 'PHONE', fallback='')
+
+            # Basic validation
+            if not app_id.isdigit():
+                self.errors.append(f'Invalid APP_ID in [{api_section}]: must be numeric')
+
+            if len(hash_id) != 32:
+                self.errors.append(f'Invalid HASH_ID in [{api_section}]: must be 32 characters')
+
+            if not phone.startswith('+'):
+                self.warnings.append(f'Phone number in [{api_section}] should start with +')
 
     def _validate_file_extensions(self):
         """Validate file extension whitelist"""
@@ -1,130 +1,223 @@
 import os
 import asyncio
 import signal
-import configparser
 from datetime import datetime, timedelta
 import redis.asyncio as redis # type: ignore
 from telethon import TelegramClient, events # type: ignore
 from telethon.tl.types import MessageMediaDocument # type: ignore
-from asyncio import Semaphore, sleep
-from typing import Dict, Optional
+from asyncio import sleep
+from collections import OrderedDict
+from typing import Dict, Optional, Set, Tuple
 
 from utils import (
-    check_file_in_history,
+    claim_file_download,
+    release_file_download,
     download_file_from_media,
-    write_log,
-    get_data_from_text
+    find_partial_downloads,
+    remove_partial_download,
+    download_progress,
+    AdaptiveRateLimiter,
+    DownloadScheduler,
+    DOWNLOAD_CONCURRENCY,
+    log_info,
+    log_error,
+    set_log_context,
+    close_logging,
+    get_data_from_text,
+    file_publisher,
+    close_outputs,
+    flush_dist_periodically,
+    watch_rules,
+    rule_sets
 )
+from settings import config, settings
 
-# Load configuration
-config = configparser.ConfigParser()
-config.read('config.ini')
+# API Configurations: one client per [TELE_API_*] section
+def _api_section_key(section: str):
+    suffix = section[len('TELE_API_'):]
+    return (0, int(suffix), '') if suffix.isdigit() else (1, 0, suffix)
 
-# API Configurations
 API_CONFIGS = [
     {
-        "id": 1,
-        "api_id": config['TELE_API_1']['APP_ID'],
-        "api_hash": config['TELE_API_1']['HASH_ID'],
-        "phone": config['TELE_API_1']['PHONE'],
-        "username": config['TELE_API_1']['USERNAME']
-    },
-    {
-        "id": 2,
-        "api_id": config['TELE_API_2']['APP_ID'],
-        "api_hash": config['TELE_API_2']['HASH_ID'],
-        "phone": config['TELE_API_2']['PHONE'],
-        "username": config['TELE_API_2']['USERNAME']
+        "id": client_id,
+        "section": section,
+        "api_id": config[section]['APP_ID'],
+        "api_hash": config[section]['HASH_ID'],
+        "phone": config[section]['PHONE'],
+        "username": config[section]['USERNAME'],
+        "download_concurrency": config.getint(section, 'DOWNLOAD_CONCURRENCY', fallback=DOWNLOAD_CONCURRENCY)
     }
+    for client_id, section in enumerate(
+        sorted((s for s in config.sections() if s.startswith('TELE_API_')), key=_api_section_key), start=1
+    )
 ]
-
-# Logging configuration
-log_file_run = config['LOGGING']['LOG_FILE_RUN']
-log_file_error = config['LOGGING']['LOG_FILE_ERROR']
+api_configs_by_id = {api_config["id"]: api_config for api_config in API_CONFIGS}
 
 # Session directory
 session_dir = config['SESSION']['SESSION_DIR']
 os.makedirs(session_dir, exist_ok=True)
 
 # Storage directory
-storage_dir = config['STORAGE']['STORAGE_DIR']
+storage_dir = settings.storage_dir
 os.makedirs(storage_dir, exist_ok=True)
 
 # History file
-history_downloaded = config['HISTORY']['HISTORY_DOWNLOADED_FILE']
+history_downloaded = settings.history_downloaded
 
 # Redis configuration
 REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379')
 redis_pool = redis.ConnectionPool.from_url(REDIS_URL, max_connections=10, decode_responses=True)
 
-# Rate limiting
-RATE_LIMIT_SEMAPHORE = Semaphore(5)  # Max 5 concurrent downloads
-DOWNLOAD_DELAY = 2  # seconds between downloads
+# Download dispatch: DOWNLOADS_PER_CLIENT workers per account share one queue,
+# request pacing per client in rate_limiters
+DOWNLOADS_PER_CLIENT = config.getint('DOWNLOAD', 'DOWNLOADS_PER_CLIENT', fallback=3)
+SEEN_EVENTS_SIZE = config.getint('DOWNLOAD', 'SEEN_EVENTS_SIZE', fallback=100000)
 
 # Global state
 shutdown_event = asyncio.Event()
 clients: Dict[int, TelegramClient] = {}
+rate_limiters: Dict[int, AdaptiveRateLimiter] = {}
 active_clients = set()
+client_load: Dict[int, int] = {}
+chat_clients: Dict[int, Set[int]] = {}
+seen_events: 'OrderedDict[Tuple[int, int], None]' = OrderedDict()
+download_queue = DownloadScheduler()
 
 async def get_redis_client() -> redis.Redis:
     """Get Redis client from connection pool"""
     return redis.Redis(connection_pool=redis_pool)
 
-async def publish_to_redis(channel: str, message: str) -> bool:
-    """Publish message to Redis channel with error handling"""
+async def publish_to_redis(file_path: str, digest: Optional[str] = None) -> bool:
+    """Queue file on the Redis work stream with error handling"""
     try:
-        r = await get_redis_client()
-        await r.publish(channel, message)
-        await r.aclose()
+        await file_publisher.publish(file_path, digest)
         return True
     except Exception as e:
-        print(f'Error publishing to Redis: {e}')
-        write_log(log_file_error, f'Redis publish error: {e}\n')
+        log_error(f'Error publishing to Redis: {e}')
+        return False
+
+def first_sighting(key: tuple) -> bool:
+    """Return True the first time a message key is seen"""
+    if key in seen_events:
+        seen_events.move_to_end(key)
         return False
+    seen_events[key] = None
+    if len(seen_events) > SEEN_EVENTS_SIZE:
+        seen_events.popitem(last=False)
+    return True
+
+def pick_client(candidates: Set[int]) -> Optional[int]:
+    """Least-loaded healthy client among candidates, preferring ones not in FloodWait"""
+    healthy = [client_id for client_id in candidates
+               if client_id in active_clients and clients[client_id].is_connected()]
+    if not healthy:
+        return None
+    return min(healthy, key=lambda client_id: (
+        rate_limiters[client_id].snapshot()['blocked_for'] > 0,
+        client_load.get(client_id, 0),
+        -rate_limiters[client_id].rate
+    ))
 
 async def handle_new_message(event, client_id: int, client: TelegramClient):
-    """Enhanced message handler with rate limiting and error handling"""
+    """Record which clients see a channel, handle each channel post once across clients"""
     try:
         message = event.message
         client_name = f"client_{client_id}"
 
+        # Channel message ids are shared by every account, so a post seen by
+        # several clients is handled once; private and basic group ids are per
+        # account and can only be deduplicated within the client that got them
+        if event.is_channel:
+            chat_clients.setdefault(event.chat_id, set()).add(client_id)
+            key = (event.chat_id, message.id)
+        else:
+            key = (client_id, event.chat_id, message.id)
+        if not first_sighting(key):
+            return
+
         if isinstance(message.media, MessageMediaDocument):
-            # Rate limiting for downloads
-            async with RATE_LIMIT_SEMAPHORE:
-                file_size = message.media.document.size
-                file_name = message.media.document.attributes[0].file_name
-
-                if not check_file_in_history(file_size, file_name):
-                    print(f'{client_name}: Downloading {file_name} ({file_size} bytes)')
-                    write_log(log_file_run, f'{client_name}: Downloading {file_name}\n')
-
-                    file_path = await download_file_from_media(client, message)
-                    if file_path:
-                        # Publish to Redis with retry
-                        success = await publish_to_redis("file_channel", file_path)
-                        if success:
-                            print(f'{client_name}: Published {file_path} to Redis')
-                        else:
-                            print(f'{client_name}: Failed to publish {file_path}')
-                    else:
-                        print(f'{client_name}: Failed to download {file_name}')
-                else:
-                    print(f'{client_name}: File already processed {file_name}')
+            file_size = message.media.document.size
+            file_name = message.media.document.attributes[0].file_name
+            mime_type = message.media.document.mime_type
 
-                # Rate limiting delay
-                await sleep(DOWNLOAD_DELAY)
+            if claim_file_download(file_size, file_name, mime_type):
+                download_queue.put((event.chat_id, message, client_id, event.is_channel), event.chat_id, file_name, file_size)
+                log_info(f'{client_name}: Queued {file_name} ({file_size} bytes)',
+                         client_id=client_id, file=file_name, size=file_size, queued=download_queue.qsize())
+            else:
+                log_info(f'{client_name}: File already processed {file_name}', client_id=client_id, file=file_name)
 
         else:
             # Process text messages
             if message.message:
-                get_data_from_text(message.message)
-                print(f'{client_name}: Processed text message')
+                get_data_from_text(message.message, f'telegram:{event.chat_id}')
+                log_info(f'{client_name}: Processed text message', client_id=client_id)
 
     except Exception as e:
         client_name = f"client_{client_id}"
-        error_msg = f'Error in {client_name} handler: {str(e)}'
-        print(error_msg)
-        write_log(log_file_error, f'{error_msg}\n')
+        log_error(f'Error in {client_name} handler: {str(e)}', client_id=client_id)
+
+async def download_job(chat_id: int, message, source_id: int, is_channel: bool):
+    """Download one queued document on the least-loaded client that can see its chat"""
+    file_size = message.media.document.size
+    file_name = message.media.document.attributes[0].file_name
+
+    # Message ids are shared by all accounts only in channels and supergroups,
+    # elsewhere another client would fetch a different message
+    candidates = chat_clients.get(chat_id, {source_id}) if is_channel else {source_id}
+    client_id = pick_client(candidates)
+    while client_id is None:
+        if shutdown_event.is_set():
+            release_file_download(file_size, file_name)
+            return
+        await sleep(5)
+        client_id = pick_client(candidates)
+
+    client = clients[client_id]
+    client_name = f"client_{client_id}"
+    loaded_id = client_id
+    client_load[loaded_id] = client_load.get(loaded_id, 0) + 1
+    try:
+        if client_id != source_id:
+            # File references are per account, fetch the message through the chosen client
+            try:
+                message = await client.get_messages(chat_id, ids=message.id) or message
+            except Exception as e:
+                log_error(f'{client_name}: Cannot fetch message {message.id}, using client_{source_id}: {e}',
+                          client_id=client_id)
+                client_id, client, client_name = source_id, clients[source_id], f"client_{source_id}"
+
+        log_info(f'{client_name}: Downloading {file_name} ({file_size} bytes)',
+                 client_id=client_id, file=file_name, size=file_size)
+
+        downloaded = await download_file_from_media(
+            client, message, rate_limiters[client_id], client_id,
+            api_configs_by_id[client_id]['download_concurrency']
+        )
+        if downloaded:
+            file_path, digest = downloaded
+            # Publish to Redis with retry
+            success = await publish_to_redis(file_path, digest)
+            if success:
+                log_info(f'{client_name}: Published {file_path} to Redis', client_id=client_id, file=file_path)
+            else:
+                log_error(f'{client_name}: Failed to publish {file_path}', client_id=client_id, file=file_path)
+        else:
+            release_file_download(file_size, file_name)
+            log_info(f'{client_name}: Nothing new downloaded from {file_name}', client_id=client_id, file=file_name)
+    finally:
+        client_load[loaded_id] -= 1
+
+async def download_worker():
+    """Take the highest ranked download job that fits on disk until cancelled"""
+    while True:
+        (chat_id, message, source_id, is_channel), size = await download_queue.get()
+        try:
+            await download_job(chat_id, message, source_id, is_channel)
+        except Exception as e:
+            log_error(f'Error in download worker: {e}', client_id=source_id)
+        finally:
+            download_queue.done(size)
 
 # Create event handlers for each client
 def create_event_handler(client_id: int):
@@ -140,13 +233,17 @@ async def initialize_clients():
         client_id = api_config["id"]
         session_file = f'{session_dir}/{api_config["username"]}'
 
+        # FloodWait is raised to us instead of slept through, the rate limiter handles it
         client = TelegramClient(
             session_file,
             api_config['api_id'],
-            api_config['api_hash']
+            api_config['api_hash'],
+            flood_sleep_threshold=0
         )
 
         clients[client_id] = client
+        rate_limiters[client_id] = AdaptiveRateLimiter()
+        client_load[client_id] = 0
 
         # Register unique event handler for this client
         client.add_event_handler(
@@ -154,29 +251,25 @@ async def initialize_clients():
             events.NewMessage
         )
 
-        print(f'Initialized client {client_id} ({api_config["username"]})')
+        log_info(f'Initialized client {client_id} ({api_config["username"]})', client_id=client_id)
 
 async def start_client(client_id: int) -> bool:
     """Start a single client with error handling"""
     client = clients[client_id]
-    api_config = API_CONFIGS[client_id - 1]
+    api_config = api_configs_by_id[client_id]
 
     try:
-        print(f'Starting client {client_id} ({api_config["username"]})')
-        write_log(log_file_run, f'Starting client {client_id}\n')
+        log_info(f'Starting client {client_id} ({api_config["username"]})', client_id=client_id)
 
         await client.start(phone=api_config['phone'])
         active_clients.add(client_id)
 
-        print(f'Client {client_id} connected successfully')
-        write_log(log_file_run, f'Client {client_id} connected\n')
+        log_info(f'Client {client_id} connected successfully', client_id=client_id)
 
         return True
 
     except Exception as e:
-        error_msg = f'Failed to start client {client_id}: {e}'
-        print(error_msg)
-        write_log(log_file_error, f'{error_msg}\n')
+        log_error(f'Failed to start client {client_id}: {e}', client_id=client_id)
         return False
 
 async def monitor_client_health():
@@ -184,29 +277,85 @@ async def monitor_client_health():
     while not shutdown_event.is_set():
         try:
             for client_id, client in clients.items():
-                if client_id not in active_clients or not client.is_connected:
-                    print(f'Client {client_id} is not connected, attempting restart...')
+                if client_id not in active_clients or not client.is_connected():
+                    log_info(f'Client {client_id} is not connected, attempting restart...', client_id=client_id)
                     # Remove from active clients
                     active_clients.discard(client_id)
 
                     # Try to restart
                     success = await start_client(client_id)
                     if success:
-                        print(f'Successfully restarted client {client_id}')
+                        log_info(f'Successfully restarted client {client_id}', client_id=client_id)
                     else:
-                        print(f'Failed to restart client {client_id}')
+                        log_error(f'Failed to restart client {client_id}', client_id=client_id)
 
             await sleep(30)  # Check every 30 seconds
 
         except Exception as e:
-            print(f'Error in health monitor: {e}')
-            write_log(log_file_error, f'Health monitor error: {e}\n')
+            log_error(f'Error in health monitor: {e}')
             await sleep(10)
 
+async def report_downloads():
+    """Print request rates and running downloads with rate and ETA periodically"""
+    while not shutdown_event.is_set():
+        await sleep(30)
+        for client_id, limiter in rate_limiters.items():
+            limit = limiter.snapshot()
+            log_info(f"client_{client_id}: request rate {limit['rate']:.2f}/{limit['max_rate']:.2f} per s, "
+                     f"blocked {limit['blocked_for']:.0f}s, FloodWaits {limit['flood_waits']}, "
+                     f"downloading {client_load.get(client_id, 0)}",
+                     client_id=client_id, rate=f"{limit['rate']:.3f}", blocked=int(limit['blocked_for']),
+                     flood_waits=limit['flood_waits'], load=client_load.get(client_id, 0))
+        if download_queue.qsize():
+            log_info(f'Download queue: {download_queue.qsize()} waiting'
+                     + (' (paused, low disk space)' if download_queue.paused else ''),
+                     queued=download_queue.qsize(), paused=download_queue.paused)
+        for download in download_progress.snapshot():
+            eta = f"{download['eta']:.0f}s" if download['eta'] is not None else 'unknown'
+            log_info(f"client_{download['client_id']}: {download['name']} "
+                     f"{download['current']}/{download['total']} bytes, "
+                     f"{download['rate'] / 1024:.1f} KiB/s, ETA {eta}",
+                     client_id=download['client_id'], file=download['name'], bytes=download['current'],
+                     rate=int(download['rate']), eta=download['eta'] and int(download['eta']))
+
+async def requeue_partial_downloads():
+    """Queue the downloads an earlier run left unfinished, drop the ones whose message is gone"""
+    for download_path, header in find_partial_downloads():
+        message, client_id = None, None
+        try:
+            if header is not None:
+                # Only channel message ids are valid for other accounts
+                candidates = [header.get('client')]
+                if header.get('channel'):
+                    candidates += sorted(active_clients - {header.get('client')})
+                for client_id in candidates:
+                    if client_id not in active_clients:
+                        continue
+                    found = await clients[client_id].get_messages(header['chat'], ids=header['message'])
+                    if (found is not None and isinstance(found.media, MessageMediaDocument)
+                            and found.media.document.id == header.get('document')):
+                        message = found
+                        break
+        except Exception as e:
+            # Kept for the next start, the message may still exist
+            log_error(f'Cannot look up the message of unfinished download {download_path}: {e}', file=download_path)
+            continue
+
+        if message is None:
+            log_info(f'Removing unfinished download {download_path}, its message is gone', file=download_path)
+            remove_partial_download(download_path)
+            continue
+        document = message.media.document
+        file_name = document.attributes[0].file_name
+        if claim_file_download(document.size, file_name, document.mime_type):
+            download_queue.put((header['chat'], message, client_id, header['channel']), header['chat'], file_name, document.size)
+            log_info(f'client_{client_id}: Resuming unfinished download {file_name}',
+                     client_id=client_id, file=file_name, size=document.size)
+
 async def shutdown_handler():
     """Handle graceful shutdown"""
     def signal_handler(signum, frame):
-        print(f'Received signal {signum}, initiating graceful shutdown...')
+        log_info(f'Received signal {signum}, initiating graceful shutdown...')
         shutdown_event.set()
 
     signal.signal(signal.SIGINT, signal_handler)
@@ -215,20 +364,24 @@ async def shutdown_handler():
     # Wait for shutdown signal
     await shutdown_event.wait()
 
-    print('Shutting down clients...')
+    log_info('Shutting down clients...')
     for client_id, client in clients.items():
         try:
-            if client.is_connected:
+            if client.is_connected():
                 await client.disconnect()
-                print(f'Disconnected client {client_id}')
+                log_info(f'Disconnected client {client_id}', client_id=client_id)
         except Exception as e:
-            print(f'Error disconnecting client {client_id}: {e}')
+            log_error(f'Error disconnecting client {client_id}: {e}', client_id=client_id)
 
 async def start():
     """Main entry point - start all clients concurrently"""
     try:
-        print('Initializing Telegram Listener...')
+        set_log_context(worker='listener')
+        log_info(f'Initializing Telegram Listener with {len(API_CONFIGS)} clients...')
+        if not API_CONFIGS:
+            raise RuntimeError('No [TELE_API_*] sections in config.ini')
         await initialize_clients()
+        file_publisher.bind(await get_redis_client())
 
         # Start shutdown handler
         shutdown_task = asyncio.create_task(shutdown_handler())
@@ -236,6 +389,20 @@ async def start():
         # Start health monitor
         health_task = asyncio.create_task(monitor_client_health())
 
+        # Start download progress reporter
+        progress_task = asyncio.create_task(report_downloads())
+
+        # Start dist output flusher
+        flush_task = asyncio.create_task(flush_dist_periodically(shutdown_event))
+
+        # Compile the rules now and swap in new versions as they are published
+        log_info(f'Using rule set {rule_sets.current().version}', rules_version=rule_sets.current().version)
+        rules_task = asyncio.create_task(watch_rules(await get_redis_client(), shutdown_event))
+
+        # Start download workers, capacity grows with the number of clients
+        worker_tasks = [asyncio.create_task(download_worker())
+                        for _ in range(DOWNLOADS_PER_CLIENT * len(clients))]
+
         # Start all clients concurrently
         client_tasks = []
         for client_id in clients.keys():
@@ -245,12 +412,19 @@ async def start():
         # Wait for all clients to start
         await asyncio.gather(*client_tasks, return_exceptions=True)
 
-        print('All clients started. Running indefinitely...')
+        # Preallocated partial files count against STORAGE_MIN_FREE until resumed or removed
+        await requeue_partial_downloads()
+
+        log_info('All clients started. Running indefinitely...')
 
         # Keep running until shutdown
         await shutdown_event.wait()
 
         # Cancel background tasks
+        for worker_task in worker_tasks:
+            worker_task.cancel()
+        await asyncio.gather(*worker_tasks, return_exceptions=True)
+        progress_task.cancel()
         health_task.cancel()
         shutdown_task.cancel()
 
@@ -260,10 +434,15 @@ async def start():
         except asyncio.CancelledError:
             pass
 
+        # Flush pending stream entries and buffered dist output
+        await file_publisher.close()
+        await rules_task
+        await flush_task
+        close_outputs()
+        close_logging()
+
     except Exception as e:
-        error_msg = f'Critical error in main: {e}'
-        print(error_msg)
-        write_log(log_file_error, f'{error_msg}\n')
+        log_error(f'Critical error in main: {e}')
         raise
 
 if __name__ == "__main__":
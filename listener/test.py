@@ -9,6 +9,6 @@ def download_file(filename):
     with open(f"./{filename}", "w") as f:
         f.write("This is the file content")
     print(f"Downloaded {filename}")
-    r.publish("file_channel", filename)
+    r.xadd("file_channel", {"path": filename})
 
 download_file("requirements.txt")
@@ -1,47 +1,381 @@
 import os
-import configparser
+import ast
+import json
+import time
+import heapq
+import asyncio
+import itertools
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional, Tuple
 from telethon import TelegramClient
+from telethon.errors import FloodWaitError
 from shared_utils import (
     check_file_in_history,
-    append_line_to_file,
-    progress_callback,
-    write_log
+    claim_file_download,
+    release_file_download,
+    download_history,
+    content_index,
+    HashingWriter,
+    hash_file,
+    log_duplicate_content,
+    remove_file,
+    free_space,
+    has_free_space,
+    file_publisher,
+    download_progress,
+    log_info,
+    log_error,
+    set_log_context,
+    close_logging,
+    get_data_from_text,
+    close_outputs,
+    flush_dist_periodically,
+    watch_rules,
+    rule_sets
 )
+from settings import config, settings
 
-config = configparser.ConfigParser()
-config.read('config.ini')
+history_downloaded = settings.history_downloaded
+storage_dir = settings.storage_dir
 
-history_downloaded = config['HISTORY']['HISTORY_DOWNLOADED_FILE']
-storage_dir = config['STORAGE']['STORAGE_DIR']
-log_file_run = config['LOGGING']['LOG_FILE_RUN']
-log_file_error = config['LOGGING']['LOG_FILE_ERROR']
+# Parallel downloads
+DOWNLOAD_CONCURRENCY = config.getint('DOWNLOAD', 'DOWNLOAD_CONCURRENCY', fallback=4)
+PARALLEL_MIN_SIZE = config.getint('DOWNLOAD', 'PARALLEL_MIN_SIZE', fallback=16 * 1024 * 1024)
+REQUEST_SIZE = 512 * 1024  # largest request Telegram serves
+PART_SIZE = config.getint('DOWNLOAD', 'PART_SIZE', fallback=8 * 1024 * 1024) // REQUEST_SIZE * REQUEST_SIZE
+
+# Download scheduling
+SCHEDULE_POLICY = config.get('SCHEDULER', 'POLICY', fallback='smallest_first')
+CHANNEL_PRIORITY = ast.literal_eval(config.get('SCHEDULER', 'CHANNEL_PRIORITY', fallback='{}'))
+TYPE_PRIORITY = ast.literal_eval(config.get('SCHEDULER', 'TYPE_PRIORITY', fallback='{}'))
+DEFAULT_PRIORITY = config.getint('SCHEDULER', 'DEFAULT_PRIORITY', fallback=5)
+STORAGE_MIN_FREE = config.getint('SCHEDULER', 'STORAGE_MIN_FREE', fallback=2 * 1024 ** 3)
+WATCH_EXTRACT_DIR = config.get('SCHEDULER', 'EXTRACT_DIR', fallback='')
+EXTRACT_MIN_FREE = config.getint('SCHEDULER', 'EXTRACT_MIN_FREE', fallback=1024 ** 3)
+DISK_CHECK_INTERVAL = config.getfloat('SCHEDULER', 'DISK_CHECK_INTERVAL', fallback=30)
+
+# Adaptive rate limiting
+RATE_INITIAL = config.getfloat('RATE_LIMIT', 'INITIAL_RATE', fallback=1.0)
+RATE_MIN = config.getfloat('RATE_LIMIT', 'MIN_RATE', fallback=0.05)
+RATE_MAX = config.getfloat('RATE_LIMIT', 'MAX_RATE', fallback=10.0)
+RATE_BURST = config.getfloat('RATE_LIMIT', 'BURST', fallback=5)
+RATE_INCREASE = config.getfloat('RATE_LIMIT', 'INCREASE_STEP', fallback=0.05)
+RATE_DECREASE = config.getfloat('RATE_LIMIT', 'DECREASE_FACTOR', fallback=0.5)
+FLOOD_RETRIES = config.getint('RATE_LIMIT', 'FLOOD_RETRIES', fallback=3)
+
+class AdaptiveRateLimiter:
+    """Token bucket for the download requests of one Telegram account.
+
+    The refill rate grows by ``increase`` per successful request up to
+    ``max_rate``. A FloodWait blocks the bucket for exactly the requested
+    number of seconds and multiplies the rate by ``decrease``.
+    """
+
+    def __init__(self, rate: float = RATE_INITIAL, min_rate: float = RATE_MIN, max_rate: float = RATE_MAX,
+                 burst: float = RATE_BURST, increase: float = RATE_INCREASE, decrease: float = RATE_DECREASE):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.flood_waits = 0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> None:
+        """Wait for a token, and for any FloodWait to expire"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def success(self) -> None:
+        """Speed up after a request Telegram accepted"""
+        self._refill(time.monotonic())
+        self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def flood_wait(self, seconds: int) -> None:
+        """Back off for as long as Telegram asked and lower the rate"""
+        now = time.monotonic()
+        self._refill(now)
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        self.tokens = 0
+        self.flood_waits += 1
+
+    def snapshot(self) -> dict:
+        """Return current rate (requests/s), its ceiling and remaining block time"""
+        return {
+            'rate': self.rate,
+            'max_rate': self.max_rate,
+            'tokens': self.tokens,
+            'blocked_for': max(0.0, self.blocked_until - time.monotonic()),
+            'flood_waits': self.flood_waits
+        }
+
+class DownloadScheduler:
+    """Ranked queue of download jobs gated by free disk space.
+
+    Jobs are ordered by channel priority, then file type priority, then
+    size (smallest_first) or arrival (fifo); lower values go first. get()
+    hands out the best job whose size fits in STORAGE_DIR above the
+    watermark, counting bytes already reserved by running downloads, and
+    waits while the extract volume is under its watermark.
+    """
+
+    def __init__(self, policy: str = SCHEDULE_POLICY, channel_priority: Dict[int, int] = CHANNEL_PRIORITY,
+                 type_priority: Dict[str, int] = TYPE_PRIORITY, default_priority: int = DEFAULT_PRIORITY):
+        self.policy = policy
+        self.channel_priority = channel_priority
+        self.type_priority = type_priority
+        self.default_priority = default_priority
+        self.reserved = 0
+        self.paused = False
+        self._heap: List[tuple] = []
+        self._seq = itertools.count()
+        self._changed = asyncio.Event()
+
+    def rank(self, chat_id: int, file_name: str, size: int) -> tuple:
+        """Sort key of a job, lower is downloaded first"""
+        extension = os.path.splitext(file_name)[1].lower()
+        return (
+            self.channel_priority.get(chat_id, self.default_priority),
+            self.type_priority.get(extension, self.default_priority),
+            size if self.policy == 'smallest_first' else 0
+        )
+
+    def put(self, job: Any, chat_id: int, file_name: str, size: int) -> None:
+        """Queue a job"""
+        heapq.heappush(self._heap, (self.rank(chat_id, file_name, size), next(self._seq), size, job))
+        self._changed.set()
+
+    def qsize(self) -> int:
+        return len(self._heap)
+
+    def _take(self) -> Optional[Tuple[Any, int]]:
+        if WATCH_EXTRACT_DIR and not has_free_space(WATCH_EXTRACT_DIR, EXTRACT_MIN_FREE):
+            return None
+        # One disk check per wake-up, jobs are then compared against the room left
+        free = free_space(storage_dir)
+        room = None if free is None else free - STORAGE_MIN_FREE - self.reserved
+        skipped, taken = [], None
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            if room is None or entry[2] <= room:
+                taken = entry
+                break
+            skipped.append(entry)
+        for entry in skipped:
+            heapq.heappush(self._heap, entry)
+        if taken is None:
+            return None
+        self.reserved += taken[2]
+        return taken[3], taken[2]
+
+    async def get(self) -> Tuple[Any, int]:
+        """Wait for the best job that fits on disk, reserving its size"""
+        while True:
+            self._changed.clear()
+            taken = self._take() if self._heap else None
+            if taken is not None:
+                if self.paused:
+                    self.paused = False
+                    log_info('Free space recovered, downloads resumed')
+                return taken
+            if self._heap and not self.paused:
+                self.paused = True
+                log_info(f'Downloads paused: {len(self._heap)} jobs wait for free space in {storage_dir}'
+                         + (f' or {WATCH_EXTRACT_DIR}' if WATCH_EXTRACT_DIR else ''), queued=len(self._heap))
+            try:
+                await asyncio.wait_for(self._changed.wait(), DISK_CHECK_INTERVAL if self._heap else None)
+            except asyncio.TimeoutError:
+                pass
+
+    def done(self, size: int) -> None:
+        """Release the reservation of a finished or failed job"""
+        self.reserved -= size
+        self._changed.set()
 
 # Listener-specific functions
 
-async def download_file_from_media(client: TelegramClient, message) -> str:
-    """Download file from Telegram media message"""
+def read_partial_download(download_path: str) -> Optional[dict]:
+    """Header of the ``.parts`` state of an unfinished download, None if missing or unreadable"""
+    try:
+        with open(f'{download_path}.parts', 'r', encoding='utf-8') as f:
+            header = json.loads(f.readline())
+        return header if isinstance(header, dict) else None
+    except (OSError, ValueError):
+        return None
+
+def remove_partial_download(download_path: str) -> None:
+    """Drop the preallocated file and the state of an unfinished download"""
+    remove_file(download_path)
+    remove_file(f'{download_path}.parts')
+
+def find_partial_downloads() -> List[Tuple[str, Optional[dict]]]:
+    """Unfinished parallel downloads left in STORAGE_DIR by an earlier run, with their headers"""
+    found = []
+    for name in sorted(os.listdir(storage_dir)):
+        if name.endswith('.parts'):
+            download_path = os.path.join(storage_dir, name[:-len('.parts')])
+            found.append((download_path, read_partial_download(download_path)))
+    return found
+
+async def download_in_parts(client: TelegramClient, message, download_path: str, size: int,
+                            concurrency: int, progress: Callable[[int, int], None],
+                            limiter: AdaptiveRateLimiter, client_id: Optional[int] = None) -> None:
+    """Download a document as byte ranges fetched concurrently.
+
+    The target file is preallocated and every part is written at its own
+    offset. ``<path>.parts`` starts with a JSON header naming the document,
+    chat, message and client, followed by the finished part indices. A
+    download resumes only from the state of the same document, and the
+    header lets a restarted listener fetch the message again.
+    """
+    state_path = f'{download_path}.parts'
+    part_count = (size + PART_SIZE - 1) // PART_SIZE
+    identity = {'document': message.media.document.id, 'chat': message.chat_id, 'message': message.id,
+                'client': client_id, 'channel': bool(message.is_channel), 'size': size}
+    header = read_partial_download(download_path)
+    done = set()
+    if (header is not None and header.get('document') == identity['document'] and header.get('size') == size
+            and os.path.exists(download_path) and os.path.getsize(download_path) == size):
+        with open(state_path, 'r', encoding='utf-8') as f:
+            f.readline()
+            done = {int(line) for line in f if line.strip().isdigit()}
+        log_info(f'Resuming {download_path} with {len(done)}/{part_count} parts done', file=download_path)
+    else:
+        if header is not None:
+            log_info(f'Discarding parts of another document at {download_path}', file=download_path)
+        with open(download_path, 'wb') as f:
+            f.truncate(size)
+        with open(state_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(identity) + '\n')
+
+    pending = deque(index for index in range(part_count) if index not in done)
+    downloaded = sum(min(PART_SIZE, size - index * PART_SIZE) for index in done)
+
+    fd = os.open(download_path, os.O_RDWR)
+    state = open(state_path, 'a', encoding='utf-8')
+
+    async def fetch_parts():
+        nonlocal downloaded
+        while pending:
+            index = pending.popleft()
+            position = index * PART_SIZE
+            await limiter.acquire()
+            async for chunk in client.iter_download(
+                message.media.document,
+                offset=position,
+                request_size=REQUEST_SIZE,
+                limit=PART_SIZE // REQUEST_SIZE,
+                file_size=size
+            ):
+                os.pwrite(fd, chunk, position)
+                position += len(chunk)
+                downloaded += len(chunk)
+                progress(downloaded, size)
+            state.write(f'{index}\n')
+            state.flush()
+            limiter.success()
+
+    tasks = [asyncio.create_task(fetch_parts()) for _ in range(max(1, min(concurrency, len(pending))))]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    finally:
+        os.close(fd)
+        state.close()
+
+    os.remove(state_path)
+
+async def fetch_document(client: TelegramClient, message, download_path: str, size: int, concurrency: int,
+                         progress: Callable[[int, int], None], limiter: AdaptiveRateLimiter,
+                         client_id: Optional[int] = None) -> Optional[Tuple[str, int]]:
+    """Download a document once, return its digest and size or None if nothing was saved"""
+    if concurrency > 1 and size >= PARALLEL_MIN_SIZE:
+        # Large documents: concurrent ranges, partial file kept for resume on FloodWait or shutdown
+        await download_in_parts(client, message, download_path, size, concurrency, progress, limiter, client_id)
+        # Parts land out of order, hash the finished file without blocking the other clients
+        return await asyncio.get_event_loop().run_in_executor(None, hash_file, download_path)
+
+    # Download file from message, hashing it as it is written
+    await limiter.acquire()
+    writer = HashingWriter(download_path)
+    try:
+        result = await client.download_media(message.media, file=writer, progress_callback=progress)
+    finally:
+        writer.close()
+    if result is None:
+        remove_file(download_path)
+        return None
+    limiter.success()
+    return writer.hexdigest(), writer.size
+
+async def download_file_from_media(client: TelegramClient, message, limiter: AdaptiveRateLimiter,
+                                   client_id: Optional[int] = None,
+                                   concurrency: int = DOWNLOAD_CONCURRENCY) -> Optional[Tuple[str, str]]:
+    """Download file from Telegram media message, return its path and SHA-256, None if it failed or its content is known"""
+    download_path = None
     try:
         size = message.media.document.size
         file_name_tmp = message.media.document.attributes[0].file_name
         file_name = str(size) + '-' + file_name_tmp
         download_path = os.path.join(storage_dir, file_name)
+        progress = download_progress.track(file_name, size, client_id)
 
-        # Download file from message
-        file_path = await client.download_media(
-            message.media,
-            file=download_path,
-            progress_callback=progress_callback
-        )
+        try:
+            for attempt in range(FLOOD_RETRIES + 1):
+                try:
+                    fetched = await fetch_document(client, message, download_path, size, concurrency, progress,
+                                                   limiter, client_id)
+                    break
+                except FloodWaitError as e:
+                    limiter.flood_wait(e.seconds)
+                    log_info(f'FloodWait of {e.seconds}s, rate lowered to {limiter.rate:.2f}/s',
+                             client_id=client_id, file=file_name, wait=e.seconds, attempt=attempt + 1)
+                    if attempt == FLOOD_RETRIES:
+                        raise
+        finally:
+            download_progress.finish(file_name)
+
+        if fetched is None:
+            return None
+        digest, written = fetched
 
-        if file_path is not None:
-            append_line_to_file(history_downloaded, file_path)
+        download_history.mark(download_path)
+        # The reader adds the digest once the file is scanned, a download that is
+        # never scanned must not hide the same content arriving again
+        if content_index.seen(digest, written):
+            log_duplicate_content(download_path, written)
+            remove_file(download_path)
+            return None
 
-        return file_path
+        return download_path, digest
 
     except Exception as e:
-        error_msg = f'Error during download: {str(e)}'
-        print(error_msg)
-        write_log(log_file_error, f'{error_msg}\n')
+        log_error(f'Error during download: {str(e)}', client_id=client_id)
+        # Only a shutdown keeps a partial file, to be resumed at the next start
+        if download_path:
+            remove_partial_download(download_path)
         return None
     
 
@@ -1,11 +1,13 @@
 import asyncio
 from reader import start
+from utils import log_error, close_logging
 
 async def main():
     try:
         await start()
     except Exception as e:
-        print(f'Error: {str(e)} (index.py:main:15)')
+        log_error(f'Error: {str(e)} (index.py:main:15)')
+        close_logging()
 
 
 if __name__ == '__main__':
@@ -2,137 +2,242 @@ import os
 import sys
 import asyncio
 import signal
-import configparser
+import socket
 import redis.asyncio as redis  # type: ignore
-from typing import Optional
-from asyncio import Semaphore, sleep
+from typing import List, Optional, Tuple
+from asyncio import sleep
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from utils import (
     read_file,
     remove_file,
-    write_log
+    release_workspace_file,
+    log_info,
+    log_error,
+    set_log_context,
+    close_logging,
+    close_outputs,
+    flush_dist_periodically,
+    shutdown_process_pool,
+    log_duplicate_content,
+    content_index,
+    file_publisher,
+    watch_rules,
+    rule_sets,
+    FILE_STREAM
 )
 
-# Load configuration
-config = configparser.ConfigParser()
-config.read('config.ini')
-
-# Logging configuration
-log_file_run = config['LOGGING']['LOG_FILE_RUN']
-log_file_error = config['LOGGING']['LOG_FILE_ERROR']
-
 # Redis configuration
 REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379')
-redis_pool = redis.ConnectionPool.from_url(REDIS_URL, max_connections=5, decode_responses=True)
+
+# Work queue configuration
+CONSUMER_GROUP = os.getenv('READER_GROUP', 'readers')
+CONSUMER_NAME = os.getenv('READER_NAME', f'{socket.gethostname()}-{os.getpid()}')
+READ_BATCH_SIZE = int(os.getenv('READ_BATCH_SIZE', '10'))
+CLAIM_IDLE_MS = int(os.getenv('CLAIM_IDLE_MS', '300000'))  # reclaim entries of consumers idle for 5 min
+CLAIM_INTERVAL = int(os.getenv('CLAIM_INTERVAL', '60'))
 
 # Processing configuration
 MAX_CONCURRENT_PROCESSING = int(os.getenv('MAX_CONCURRENT_PROCESSING', '3'))
-PROCESSING_SEMAPHORE = Semaphore(MAX_CONCURRENT_PROCESSING)
+PROCESSING_QUEUE_SIZE = int(os.getenv('PROCESSING_QUEUE_SIZE', str(MAX_CONCURRENT_PROCESSING * 2)))
+
+# One blocking stream reader, one reclaimer, the publisher, the rules channel and an ack per active file
+redis_pool = redis.ConnectionPool.from_url(REDIS_URL, max_connections=MAX_CONCURRENT_PROCESSING + 6, decode_responses=True)
 
 # Global state
 shutdown_event = asyncio.Event()
 processing_stats = {
     'files_processed': 0,
     'errors': 0,
-    'start_time': None
+    'start_time': None,
+    'active': 0
 }
+in_flight = set()
+
+# Bounded work queue feeding a fixed pool of processing workers; intake
+# blocks on put() when it is full, so Redis is only read as fast as files finish
+work_queue: asyncio.Queue = asyncio.Queue(maxsize=PROCESSING_QUEUE_SIZE)
+queue_space = asyncio.Event()
 
 async def get_redis_client() -> redis.Redis:
     """Get Redis client from connection pool"""
     return redis.Redis(connection_pool=redis_pool)
 
-async def subscribe_to_channel(channel: str) -> Optional[redis.Redis]:
-    """Subscribe to Redis channel with error handling"""
+async def ensure_consumer_group(r: redis.Redis) -> None:
+    """Create the reader consumer group on the file stream if needed"""
+    try:
+        await r.xgroup_create(FILE_STREAM, CONSUMER_GROUP, id='0', mkstream=True)
+        log_info(f'Created consumer group {CONSUMER_GROUP} on stream {FILE_STREAM}')
+    except redis.ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+async def acknowledge(message_id: str):
+    """Acknowledge a stream entry once its file has been handled"""
     try:
         r = await get_redis_client()
-        pubsub = r.pubsub()
-        await pubsub.subscribe(channel)
-        print(f'Successfully subscribed to channel: {channel}')
-        return pubsub
+        await r.xack(FILE_STREAM, CONSUMER_GROUP, message_id)
     except Exception as e:
-        print(f'Failed to subscribe to channel {channel}: {e}')
-        write_log(log_file_error, f'Redis subscription error: {e}\n')
-        return None
+        log_error(f'Error acknowledging message {message_id}: {e}')
 
-async def process_file_message(file_path: str):
-    """Process a single file message with rate limiting"""
-    async with PROCESSING_SEMAPHORE:
-        try:
-            print(f"Processing file: {file_path}")
-
-            if not os.path.exists(file_path):
-                print(f"File not found: {file_path}")
-                return
-
-            # Process the file
-            result = await read_file(file_path)
-            if result:
-                # Remove processed file
-                remove_file(file_path)
-                processing_stats['files_processed'] += 1
-                print(f"Successfully processed: {file_path}")
-                write_log(log_file_run, f'Processed file: {file_path}\n')
-            else:
-                processing_stats['errors'] += 1
-                print(f"Failed to process: {file_path}")
-                write_log(log_file_error, f'Failed to process file: {file_path}\n')
+async def process_file_message(file_path: str, message_id: Optional[str] = None,
+                               digest: Optional[str] = None):
+    """Process a single file message, digest is the SHA-256 of its content when the publisher knew it"""
+    started = asyncio.get_event_loop().time()
+    try:
+        log_info(f"Processing file: {file_path}", file=file_path)
+
+        if not os.path.exists(file_path):
+            log_error(f"File not found: {file_path}", file=file_path)
+            return
+
+        # Same content may have been scanned since it was published
+        size = os.path.getsize(file_path)
+        if digest and content_index.seen(digest, size):
+            log_duplicate_content(file_path, size)
+            remove_file(file_path)
+            return
+
+        # Process the file
+        result = await read_file(file_path)
+        if result:
+            # Only scanned content counts as seen, a failure leaves it to the retry
+            if digest:
+                content_index.add(digest)
+            # Remove processed file
+            remove_file(file_path)
+            processing_stats['files_processed'] += 1
+            duration = asyncio.get_event_loop().time() - started
+            log_info(f"Successfully processed: {file_path}", file=file_path, duration=f'{duration:.3f}')
+        else:
+            processing_stats['errors'] += 1
+            log_error(f"Failed to process: {file_path}", file=file_path)
 
+    except Exception as e:
+        processing_stats['errors'] += 1
+        log_error(f'Error processing file {file_path}: {e}', file=file_path)
+
+    finally:
+        # Archive members are scratch copies, drop them with their workspace
+        release_workspace_file(file_path)
+        if message_id is not None:
+            in_flight.discard(message_id)
+            await acknowledge(message_id)
+
+async def dispatch_entries(r: redis.Redis, entries: List[Tuple[str, dict]]) -> int:
+    """Queue stream entries not already in flight, return how many were queued.
+
+    Callers read no more entries than there are free slots, so this never
+    waits; an entry that still finds the queue full stays pending and is
+    reclaimed once it has been idle for CLAIM_IDLE_MS. Entries trimmed
+    from the stream or without a path are acknowledged right away, as no
+    reader could ever handle them.
+    """
+    queued = 0
+    unusable = []
+    for message_id, fields in entries:
+        if message_id in in_flight:
+            continue
+        file_path = fields.get('path') if fields else None
+        if not file_path:
+            unusable.append(message_id)
+            continue
+        try:
+            work_queue.put_nowait((file_path, message_id, fields.get('digest')))
+        except asyncio.QueueFull:
+            log_info(f"Queue full, leaving {file_path} pending", file=file_path)
+            continue
+        log_info(f"Received file signal: {file_path}", file=file_path)
+        in_flight.add(message_id)
+        queued += 1
+    if unusable:
+        log_error(f'Dropping {len(unusable)} stream entries without a file path')
+        await r.xack(FILE_STREAM, CONSUMER_GROUP, *unusable)
+    return queued
+
+def free_slots() -> int:
+    """Number of entries the work queue can take without blocking"""
+    return work_queue.maxsize - work_queue.qsize()
+
+async def processing_worker():
+    """Process queued files one at a time until cancelled"""
+    while True:
+        file_path, message_id, digest = await work_queue.get()
+        queue_space.set()
+        processing_stats['active'] += 1
+        try:
+            await process_file_message(file_path, message_id, digest)
+        finally:
+            processing_stats['active'] -= 1
+            work_queue.task_done()
+
+async def reclaim_pending(r: redis.Redis):
+    """Keep own entries alive and take over entries of crashed consumers"""
+    # Reset idle time of entries this reader is still working on
+    if in_flight:
+        await r.xclaim(FILE_STREAM, CONSUMER_GROUP, CONSUMER_NAME, 0, list(in_flight), justid=True)
+
+    # Take no new work once shutdown started
+    start_id = '0-0'
+    while free_slots() > 0 and not shutdown_event.is_set():
+        result = await r.xautoclaim(FILE_STREAM, CONSUMER_GROUP, CONSUMER_NAME, CLAIM_IDLE_MS,
+                                    start_id=start_id, count=min(READ_BATCH_SIZE, free_slots()))
+        start_id, entries = result[0], result[1]
+        if entries:
+            log_info(f'Reclaimed {len(entries)} pending entries')
+            await dispatch_entries(r, entries)
+        if start_id == '0-0':
+            break
+
+async def maintain_claims():
+    """Run the keepalive and reclaim on their own schedule, independent of intake, until cancelled"""
+    while True:
+        try:
+            await reclaim_pending(await get_redis_client())
         except Exception as e:
-            processing_stats['errors'] += 1
-            error_msg = f'Error processing file {file_path}: {e}'
-            print(error_msg)
-            write_log(log_file_error, f'{error_msg}\n')
+            log_error(f'Error reclaiming pending entries: {e}')
+        await sleep(CLAIM_INTERVAL)
 
 async def listen_for_messages():
-    """Async message listener with reconnection logic"""
-    channel = "file_channel"
-    max_retries = 5
+    """Consume the file stream as part of the reader consumer group"""
     retry_delay = 5
 
     while not shutdown_event.is_set():
-        pubsub = None
         try:
-            print("Attempting to connect to Redis...")
-            pubsub = await subscribe_to_channel(channel)
+            log_info("Attempting to connect to Redis...")
+            r = await get_redis_client()
+            await ensure_consumer_group(r)
 
-            if not pubsub:
-                await sleep(retry_delay)
-                continue
+            log_info(f"Reader {CONSUMER_NAME} started, consuming {FILE_STREAM}...")
+            retry_delay = 5
 
-            print("Reader started, listening for new file signals...")
+            # Pick up entries this consumer left pending before a restart
+            stream_id = '0'
 
-            # Listen for messages asynchronously
             while not shutdown_event.is_set():
-                try:
-                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
-
-                    if message and message["type"] == "message":
-                        file_path = message["data"]
-                        print(f"Received file signal: {file_path}")
-
-                        # Process file asynchronously
-                        asyncio.create_task(process_file_message(file_path))
-
-                except Exception as e:
-                    print(f'Error receiving message: {e}')
-                    break
+                # Only read what the queue can take right now
+                count = min(READ_BATCH_SIZE, free_slots())
+                if count <= 0:
+                    queue_space.clear()
+                    await queue_space.wait()
+                    continue
+
+                response = await r.xreadgroup(CONSUMER_GROUP, CONSUMER_NAME, {FILE_STREAM: stream_id},
+                                              count=count, block=1000)
+                entries = response[0][1] if response else []
+                await dispatch_entries(r, entries)
+
+                if stream_id != '>':
+                    # Page through pending history, then switch to new entries
+                    stream_id = entries[-1][0] if len(entries) == count else '>'
 
         except Exception as e:
-            print(f'Redis connection error: {e}')
-            write_log(log_file_error, f'Redis connection error: {e}\n')
+            log_error(f'Redis connection error: {e}')
 
         finally:
-            if pubsub:
-                try:
-                    await pubsub.unsubscribe()
-                    await pubsub.aclose()
-                except Exception as e:
-                    print(f'Error closing pubsub: {e}')
-
             if not shutdown_event.is_set():
-                print(f'Retrying connection in {retry_delay} seconds...')
+                log_info(f'Retrying connection in {retry_delay} seconds...')
                 await sleep(retry_delay)
                 retry_delay = min(retry_delay * 2, 60)  # Exponential backoff, max 60s
 
@@ -140,27 +245,33 @@ async def print_stats():
     """Print processing statistics periodically"""
     while not shutdown_event.is_set():
         await sleep(60)  # Print stats every minute
-        if processing_stats['files_processed'] > 0 or processing_stats['errors'] > 0:
-            print(f"Stats - Processed: {processing_stats['files_processed']}, Errors: {processing_stats['errors']}")
+        if processing_stats['files_processed'] > 0 or processing_stats['errors'] > 0 or in_flight:
+            log_info(f"Stats - Processed: {processing_stats['files_processed']}, Errors: {processing_stats['errors']}, "
+                     f"Queued: {work_queue.qsize()}/{PROCESSING_QUEUE_SIZE}, Active: {processing_stats['active']}, "
+                     f"Duplicates skipped: {content_index.stats['duplicates']} ({content_index.stats['bytes_skipped']} bytes)",
+                     processed=processing_stats['files_processed'], errors=processing_stats['errors'],
+                     queued=work_queue.qsize(), active=processing_stats['active'])
 
 async def shutdown_handler():
     """Handle graceful shutdown"""
     def signal_handler(signum, frame):
-        print(f'Received signal {signum}, initiating graceful shutdown...')
+        log_info(f'Received signal {signum}, initiating graceful shutdown...')
         shutdown_event.set()
 
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
 
     await shutdown_event.wait()
-    print('Reader shutdown complete.')
+    log_info('Reader shutdown complete.')
 
 async def start():
     """Main entry point"""
     try:
         processing_stats['start_time'] = asyncio.get_event_loop().time()
 
-        print('Starting Telegram Reader...')
+        set_log_context(worker='reader', consumer=CONSUMER_NAME)
+        log_info('Starting Telegram Reader...')
+        file_publisher.bind(await get_redis_client())
 
         # Start shutdown handler
         shutdown_task = asyncio.create_task(shutdown_handler())
@@ -168,14 +279,39 @@ async def start():
         # Start stats printer
         stats_task = asyncio.create_task(print_stats())
 
+        # Start dist output flusher
+        flush_task = asyncio.create_task(flush_dist_periodically(shutdown_event))
+
+        # Compile the rules now and swap in new versions as they are published
+        log_info(f'Using rule set {rule_sets.current().version}', rules_version=rule_sets.current().version)
+        rules_task = asyncio.create_task(watch_rules(await get_redis_client(), shutdown_event))
+
+        # Start processing workers
+        worker_tasks = [asyncio.create_task(processing_worker()) for _ in range(MAX_CONCURRENT_PROCESSING)]
+
+        # Start claim keepalive and reclaim of crashed consumers' entries
+        claims_task = asyncio.create_task(maintain_claims())
+
         # Start message listener
         listener_task = asyncio.create_task(listen_for_messages())
 
         # Wait for shutdown
         await shutdown_event.wait()
 
-        # Cancel background tasks
+        # Stop intake, then let workers drain what is already queued
         listener_task.cancel()
+        log_info(f'Draining {work_queue.qsize()} queued files...')
+        await work_queue.join()
+        for worker_task in worker_tasks:
+            worker_task.cancel()
+        await asyncio.gather(*worker_tasks, return_exceptions=True)
+        # Queued entries stayed claimed while draining
+        claims_task.cancel()
+        await asyncio.gather(claims_task, return_exceptions=True)
+        shutdown_process_pool()
+        await file_publisher.close()
+        await rules_task
+
         stats_task.cancel()
         shutdown_task.cancel()
 
@@ -186,13 +322,16 @@ async def start():
         except asyncio.CancelledError:
             pass
 
+        # Flush buffered dist output
+        await flush_task
+        close_outputs()
+
         # Final stats
-        print(f"Final stats - Processed: {processing_stats['files_processed']}, Errors: {processing_stats['errors']}")
+        log_info(f"Final stats - Processed: {processing_stats['files_processed']}, Errors: {processing_stats['errors']}")
+        close_logging()
 
     except Exception as e:
-        error_msg = f'Critical error in reader: {e}'
-        print(error_msg)
-        write_log(log_file_error, f'{error_msg}\n')
+        log_error(f'Critical error in reader: {e}')
         raise
 
 if __name__ == "__main__":
@@ -2,13 +2,12 @@
 import redis
 
 r = redis.Redis()
-pubsub = r.pubsub()
-pubsub.subscribe("file_channel")  # Đăng ký kênh
+last_id = "$"
 
 print("Đang lắng nghe thông báo từ 'file_channel'...")
 
-for message in pubsub.listen():
-    if message["type"] == "message":
-        filename = message["data"].decode()
-        print(f"📥 Nhận được tín hiệu file mới: {filename}")
-      
\ No newline at end of file
+while True:
+    for _, entries in r.xread({"file_channel": last_id}, block=0):
+        for last_id, fields in entries:
+            filename = fields[b"path"].decode()
+            print(f"📥 Nhận được tín hiệu file mới: {filename}")
@@ -1,65 +1,116 @@
 import os
-import configparser
-import redis.asyncio as redis
+import asyncio
 from shared_utils import (
     read_file_txt,
+    read_file_table,
+    read_file_transcoded,
+    sniff_file,
+    needs_transcoding,
+    KIND_EXTENSIONS,
     remove_file,
     extract_file,
-    write_log
+    create_workspace,
+    remove_workspace,
+    release_workspace_file,
+    stream_archive,
+    has_free_space,
+    file_publisher,
+    FILE_STREAM,
+    log_info,
+    log_error,
+    set_log_context,
+    close_logging,
+    close_outputs,
+    flush_dist_periodically,
+    watch_rules,
+    rule_sets,
+    shutdown_process_pool,
+    log_duplicate_content,
+    content_index
 )
+from settings import config, settings
 
-config = configparser.ConfigParser()
-config.read('config.ini')
-
-extract_dir = config['EXTRACT']['EXTRACT_DIR']
+extract_dir = settings.extract_dir
+stream_archives = config.getboolean('EXTRACT', 'STREAM_ARCHIVES', fallback=True)
+extract_min_free = settings.extract_min_free
+disk_check_interval = settings.disk_check_interval
 
 # Reader-specific functions
 
+async def wait_for_extract_space(file_path: str) -> None:
+    """Defer extraction while the extract volume would fall under its watermark"""
+    needed = os.path.getsize(file_path)
+    if has_free_space(extract_dir, extract_min_free, needed):
+        return
+    log_info(f'Extraction of {file_path} deferred, low free space in {extract_dir}', file=file_path)
+    while not has_free_space(extract_dir, extract_min_free, needed):
+        await asyncio.sleep(disk_check_interval)
+    log_info(f'Free space recovered, extracting {file_path}', file=file_path)
+
 async def read_file(file_path: str):
-    """Process file based on extension"""
+    """Process file based on its content, the extension only breaks ties"""
     try:
-        _, file_extension = os.path.splitext(file_path)
-        if file_extension == '.txt':
-            return await read_file_txt(file_path)
-        elif file_extension in ['.rar', '.zip', '.7z']:
-            return await extract_and_publish(file_path, file_extension)
+        file_extension = os.path.splitext(file_path)[1].lower()
+        kind, encoding = sniff_file(file_path)
+        if kind == 'binary':
+            # Nothing a line rule could match, drop it without scanning
+            log_info(f'Skipping binary file: {file_path}', file=file_path)
+            return file_path
+        elif kind in KIND_EXTENSIONS:
+            extension = KIND_EXTENSIONS[kind]
+            if stream_archives:
+                # Decompression and matching would otherwise stall the event loop
+                loop = asyncio.get_event_loop()
+                if await loop.run_in_executor(None, stream_archive, file_path, extension, kind):
+                    return file_path
+            await wait_for_extract_space(file_path)
+            return await extract_and_publish(file_path, extension)
+        elif kind == 'xlsx':
+            return await read_file_table(file_path, '.xlsx')
+        elif file_extension == '.csv':
+            return await read_file_table(file_path, '.csv', encoding)
+        elif needs_transcoding(encoding):
+            return await read_file_transcoded(file_path, encoding)
         else:
-            print(f'Unsupported file type: {file_extension}')
-            return None
+            return await read_file_txt(file_path)
     except Exception as e:
-        error_msg = f'Error reading file: {str(e)}'
-        print(error_msg)
+        log_error(f'Error reading file: {str(e)}', file=file_path)
         return None
 
 async def extract_and_publish(file_path: str, extension: str):
-    """Extract archive and publish extracted files to Redis"""
+    """Extract archive into its own workspace and queue its members on the file stream"""
+    workspace = create_workspace()
     try:
         # Extract the file
-        result = extract_file(file_path, extension)
-        if result:
-            # Import here to avoid circular imports
-            import redis.asyncio as redis
-            from shared_utils import flatten_extracted_files
+        extracted_files = extract_file(file_path, extension, workspace)
+        if extracted_files is None:
+            remove_workspace(workspace)
+            return None
 
-            # Get Redis client
-            REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379')
-            r = redis.Redis.from_url(REDIS_URL)
+        # Publish this job's members in pipelined batches, drop the ones the reader cannot handle
+        members, digests = [], []
+        for extracted_file, digest in extracted_files:
+            if sniff_file(extracted_file)[0] != 'binary':
+                members.append(extracted_file)
+                digests.append(digest)
+            else:
+                remove_file(extracted_file)
 
-            # Get extracted files and publish to Redis
-            extract_file_tmp = flatten_extracted_files(extract_dir)
-            for extracted_file in extract_file_tmp:
-                try:
-                    await r.publish("file_channel", extracted_file)
-                    print(f'Published extracted file to Redis: {extracted_file}')
-                except Exception as e:
-                    print(f'Error publishing extracted file {extracted_file}: {e}')
+        published = 0
+        results = await file_publisher.publish_many(members, digests)
+        for extracted_file, result in zip(members, results):
+            if isinstance(result, Exception):
+                remove_file(extracted_file)
+                log_error(f'Error publishing extracted file {extracted_file}: {result}', file=extracted_file)
+            else:
+                published += 1
+        log_info(f'Published {published}/{len(members)} extracted files to Redis', file=file_path)
 
-            await r.aclose()
-            return file_path
-        else:
-            return None
+        if published == 0:
+            remove_workspace(workspace)
+        return file_path
 
     except Exception as e:
-        error_msg = f'Error extracting and publishing file: {str(e)}'
-        print(error_msg)
+        remove_workspace(workspace)
+        log_error(f'Error extracting and publishing file: {str(e)}', file=file_path)
         return None
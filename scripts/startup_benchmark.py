@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Startup benchmark for Wendy workers
+Imports each worker entry module in a fresh interpreter, like `python -X importtime`,
+and reports wall time plus the slowest imports.
+"""
+
+import os
+import sys
+import time
+import statistics
+import subprocess
+from typing import Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Worker directory (config.ini is read from the cwd) and its entry module
+WORKERS = {
+    'listener': 'telegram_listener',
+    'reader': 'reader'
+}
+
+def parse_importtime(stderr: str) -> list:
+    """Return (cumulative us, module) pairs from -X importtime output"""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line.split('|', 2)
+        imports.append((int(cumulative), module.rstrip()))
+    return imports
+
+def benchmark(worker: str, module: str, runs: int, top: int) -> Optional[float]:
+    """Import a worker module runs times, print timings and return the median in seconds"""
+    cwd = os.path.join(ROOT, worker)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, os.environ.get('PYTHONPATH', '')]))
+    command = [sys.executable, '-X', 'importtime', '-c', f'import {module}']
+
+    durations = []
+    stderr = ''
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = subprocess.run(command, cwd=cwd, env=env, capture_output=True, text=True)
+        durations.append(time.perf_counter() - started)
+        stderr = result.stderr
+        if result.returncode != 0:
+            print(f"❌ {worker}: import {module} failed")
+            print(stderr.splitlines()[-1] if stderr else '')
+            return None
+
+    median = statistics.median(durations)
+    print(f"\n⏱️  {worker}: import {module} median {median * 1000:.0f} ms "
+          f"(min {min(durations) * 1000:.0f} ms, {runs} runs)")
+    for cumulative, name in sorted(parse_importtime(stderr), reverse=True)[:top]:
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+    return median
+
+def main():
+    """Benchmark every worker, exit 1 if one fails or is over the budget"""
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Measure worker startup import time')
+    parser.add_argument('workers', nargs='*', default=list(WORKERS), help='workers to measure')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15, help='slowest imports to list')
+    parser.add_argument('--budget', type=float, default=1.0, help='max median startup in seconds')
+    args = parser.parse_args()
+
+    over_budget = False
+    for worker in args.workers:
+        median = benchmark(worker, WORKERS[worker], args.runs, args.top)
+        if median is None:
+            over_budget = True
+        elif median > args.budget:
+            print(f"⚠️  {worker} is over the {args.budget:.2f}s startup budget")
+            over_budget = True
+
+    return 1 if over_budget else 0
+
+if __name__ == '__main__':
+    exit(main())
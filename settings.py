@@ -0,0 +1,114 @@
+"""
+Settings for Wendy Telegram Data Collection System
+Parses the worker's config.ini once and exposes the shared keys as a typed object.
+"""
+
+import os
+import configparser
+from dataclasses import dataclass
+
+# Archive formats the reader unpacks
+ARCHIVE_FILE_TYPES = ('.rar', '.zip', '.7z', '.tar', '.gz', '.tgz', '.bz2', '.tbz2', '.xz', '.txz')
+
+# Parsed once per process, worker modules read their own sections from it
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+@dataclass(frozen=True)
+class Settings:
+    """Typed view of the sections shared_utils uses, defaults live in load_settings"""
+
+    # Paths
+    log_file_run: str
+    log_file_error: str
+    storage_dir: str
+    dist_dir: str
+    data_rules_path: str
+    white_file_types: str
+    extract_dir: str
+    history_downloaded: str
+    content_index_file: str
+    checkpoint_dir: str
+    link_rules_path: str
+    links_dir: str
+
+    # Logging
+    log_max_bytes: int
+    log_backup_count: int
+    log_rotate_interval: int
+
+    # Dist output buffering
+    dist_buffer_size: int
+    dist_flush_bytes: int
+    dist_flush_interval: float
+
+    # Record deduplication
+    dedup_enabled: bool
+    dedup_scope: str
+    dedup_dir: str
+    dedup_bloom_bits: int
+    dedup_hashes: int
+    dedup_shards: int
+    dedup_cached_shards: int
+
+    # Link extraction
+    links_enabled: bool
+
+    # Spreadsheet ingestion
+    row_separator: str
+
+    # Archive trees
+    archive_file_types: tuple
+    nested_max_depth: int
+    archive_max_total_size: int
+    archive_max_ratio: int
+    archive_max_members: int
+    nested_spool_size: int
+    extract_min_free: int
+    disk_check_interval: float
+
+def load_settings(parser: configparser.ConfigParser) -> Settings:
+    """Build Settings from a parsed config, required keys raise KeyError"""
+    storage_dir = parser['STORAGE']['STORAGE_DIR']
+    dist_buffer_size = parser.getint('DIST', 'DIST_BUFFER_SIZE', fallback=1024 * 1024)
+    return Settings(
+        log_file_run=parser['LOGGING']['LOG_FILE_RUN'],
+        log_file_error=parser['LOGGING']['LOG_FILE_ERROR'],
+        storage_dir=storage_dir,
+        dist_dir=parser['DIST']['DIST_DIR'],
+        data_rules_path=parser['RULES']['DATA_RULES'],
+        white_file_types=parser.get('WHITELIST', 'WHITELIST_FILE_TYPES', fallback=''),
+        # Only the reader extracts and only the listener keeps download history
+        extract_dir=parser.get('EXTRACT', 'EXTRACT_DIR', fallback='./extract'),
+        history_downloaded=parser.get('HISTORY', 'HISTORY_DOWNLOADED_FILE', fallback='./history_downloaded.txt'),
+        content_index_file=parser.get('STORAGE', 'CONTENT_INDEX_FILE',
+                                      fallback=os.path.join(storage_dir, 'content_index.txt')),
+        checkpoint_dir=parser.get('CHECKPOINT', 'CHECKPOINT_DIR', fallback='./checkpoints'),
+        link_rules_path=parser.get('RULES', 'LINK_RULES', fallback=''),
+        links_dir=parser.get('LINKS', 'LINKS_DIR', fallback='../links'),
+        log_max_bytes=parser.getint('LOGGING', 'LOG_MAX_BYTES', fallback=50 * 1024 * 1024),
+        log_backup_count=parser.getint('LOGGING', 'LOG_BACKUP_COUNT', fallback=5),
+        log_rotate_interval=parser.getint('LOGGING', 'LOG_ROTATE_INTERVAL', fallback=24 * 60 * 60),
+        dist_buffer_size=dist_buffer_size,
+        dist_flush_bytes=parser.getint('DIST', 'DIST_FLUSH_BYTES', fallback=dist_buffer_size),
+        dist_flush_interval=parser.getfloat('DIST', 'DIST_FLUSH_INTERVAL', fallback=5.0),
+        dedup_enabled=parser.getboolean('DEDUP', 'DEDUP_ENABLED', fallback=True),
+        dedup_scope=parser.get('DEDUP', 'DEDUP_SCOPE', fallback='daily'),
+        dedup_dir=parser.get('DEDUP', 'DEDUP_DIR', fallback='./dedup'),
+        dedup_bloom_bits=parser.getint('DEDUP', 'DEDUP_BLOOM_BITS', fallback=2 ** 27),
+        dedup_hashes=parser.getint('DEDUP', 'DEDUP_HASHES', fallback=7),
+        dedup_shards=parser.getint('DEDUP', 'DEDUP_SHARDS', fallback=1024),
+        dedup_cached_shards=parser.getint('DEDUP', 'DEDUP_CACHED_SHARDS', fallback=16),
+        links_enabled=parser.getboolean('LINKS', 'LINKS_ENABLED', fallback=True),
+        row_separator=parser.get('WHITELIST', 'ROW_SEPARATOR', fallback=':'),
+        archive_file_types=ARCHIVE_FILE_TYPES,
+        nested_max_depth=parser.getint('EXTRACT', 'NESTED_MAX_DEPTH', fallback=5),
+        archive_max_total_size=parser.getint('EXTRACT', 'ARCHIVE_MAX_TOTAL_SIZE', fallback=20 * 1024 ** 3),
+        archive_max_ratio=parser.getint('EXTRACT', 'ARCHIVE_MAX_RATIO', fallback=250),
+        archive_max_members=parser.getint('EXTRACT', 'ARCHIVE_MAX_MEMBERS', fallback=100000),
+        nested_spool_size=parser.getint('EXTRACT', 'NESTED_SPOOL_SIZE', fallback=64 * 1024 * 1024),
+        extract_min_free=parser.getint('EXTRACT', 'EXTRACT_MIN_FREE', fallback=1024 ** 3),
+        disk_check_interval=parser.getfloat('EXTRACT', 'DISK_CHECK_INTERVAL', fallback=30)
+    )
+
+settings = load_settings(config)
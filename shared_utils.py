@@ -5,87 +5,1228 @@ This module contains common functions used by both listener and reader component
 
 import os
 import re
-import yaml
-import configparser
 import shutil
-import rarfile  # type: ignore
-import pyzipper  # type: ignore
-import py7zr  # type: ignore
-from datetime import date
-from typing import List, Optional
-
-# Configuration
-config = configparser.ConfigParser()
-config.read('config.ini')
+import tempfile
+import time
+import asyncio
+import threading
+import itertools
+import json
+import hashlib
+import atexit
+import queue
+import sys
+import mmap
+import codecs
+import io
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict
+from datetime import date, datetime
+from typing import IO, Callable, Iterable, Iterator, List, Optional, Tuple
+from settings import settings
 
 # Paths
-log_file_run = config['LOGGING']['LOG_FILE_RUN']
-log_file_error = config['LOGGING']['LOG_FILE_ERROR']
-history_downloaded = config['HISTORY']['HISTORY_DOWNLOADED_FILE']
-storage_dir = config['STORAGE']['STORAGE_DIR']
-white_file_types = config['WHITELIST']['WHITELIST_FILE_TYPES']
-data_rules_path = config['RULES']['DATA_RULES']
-dist_dir = config['DIST']['DIST_DIR']
-extract_dir = config['EXTRACT']['EXTRACT_DIR']
+log_file_run = settings.log_file_run
+log_file_error = settings.log_file_error
+log_max_bytes = settings.log_max_bytes
+log_backup_count = settings.log_backup_count
+log_rotate_interval = settings.log_rotate_interval
+history_downloaded = settings.history_downloaded
+storage_dir = settings.storage_dir
+content_index_file = settings.content_index_file
+white_file_types = settings.white_file_types
+archive_file_types = list(settings.archive_file_types)
+nested_max_depth = settings.nested_max_depth
+archive_max_total_size = settings.archive_max_total_size
+archive_max_ratio = settings.archive_max_ratio
+archive_max_members = settings.archive_max_members
+nested_spool_size = settings.nested_spool_size
+extract_min_free = settings.extract_min_free
+disk_check_interval = settings.disk_check_interval
+data_rules_path = settings.data_rules_path
+dist_dir = settings.dist_dir
+extract_dir = settings.extract_dir
+
+# Dist output buffering
+dist_buffer_size = settings.dist_buffer_size
+dist_flush_bytes = settings.dist_flush_bytes
+dist_flush_interval = settings.dist_flush_interval
+
+# Record deduplication
+dedup_enabled = settings.dedup_enabled
+dedup_scope = settings.dedup_scope
+dedup_dir = settings.dedup_dir
+dedup_bloom_bits = settings.dedup_bloom_bits
+dedup_hashes = settings.dedup_hashes
+dedup_shards = settings.dedup_shards
+dedup_cached_shards = settings.dedup_cached_shards
+
+# Resumable processing
+checkpoint_dir = settings.checkpoint_dir
+
+# Spreadsheet rows are joined into one line per row
+row_separator = settings.row_separator
+
+# Link extraction
+link_rules_path = settings.link_rules_path
+links_dir = settings.links_dir
+links_enabled = settings.links_enabled
+
+# Rules hot reload
+RULES_CHANNEL = os.getenv('RULES_CHANNEL', 'rules_control')
+RULES_CHECK_INTERVAL = float(os.getenv('RULES_CHECK_INTERVAL', '5'))
+
+# Parallel text processing
+PROCESS_POOL_WORKERS = int(os.getenv('PROCESS_POOL_WORKERS', str(os.cpu_count() or 1)))
+READ_CHUNK_SIZE = int(os.getenv('READ_CHUNK_SIZE', str(32 * 1024 * 1024)))
+STREAM_READ_SIZE = 1024 * 1024
+
+# Decoding of matched byte spans
+DECODE_FALLBACK_ENCODING = os.getenv('DECODE_FALLBACK_ENCODING', 'latin-1')
+DECODE_ERRORS = os.getenv('DECODE_ERRORS', 'replace')
+
+# File work queue (Redis stream shared by listener and reader)
+FILE_STREAM = os.getenv('FILE_STREAM', 'file_channel')
+FILE_STREAM_MAXLEN = int(os.getenv('FILE_STREAM_MAXLEN', '1000000'))
+
+PUBLISH_BATCH_SIZE = int(os.getenv('PUBLISH_BATCH_SIZE', '500'))
+PUBLISH_LINGER_MS = int(os.getenv('PUBLISH_LINGER_MS', '50'))
+
+class StreamPublisher:
+    """Batches file stream entries into pipelined XADDs.
+
+    Entries are sent once ``batch_size`` are pending or ``linger`` seconds
+    after the first of a batch arrived, one round-trip per batch. The
+    Redis client is bound by the worker so its connection pool is reused.
+    """
+
+    def __init__(self, stream: str, maxlen: int, batch_size: int, linger: float):
+        self.stream = stream
+        self.maxlen = maxlen
+        self.batch_size = max(1, batch_size)
+        self.linger = linger
+        self._client = None
+        self._pending: List[Tuple[dict, asyncio.Future]] = []
+        self._timer: Optional[asyncio.Task] = None
+
+    def bind(self, client) -> None:
+        """Use a Redis client built on the worker connection pool"""
+        self._client = client
+
+    def _enqueue(self, file_path: str, digest: Optional[str]) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        fields = {'path': file_path}
+        if digest:
+            # The reader adds it to the content index once the file is scanned
+            fields['digest'] = digest
+        self._pending.append((fields, future))
+        return future
+
+    async def publish(self, file_path: str, digest: Optional[str] = None) -> str:
+        """Queue one path, with the SHA-256 of its content when known, and wait for its stream entry id"""
+        future = self._enqueue(file_path, digest)
+        if len(self._pending) >= self.batch_size:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+        return await future
+
+    async def publish_many(self, file_paths: Iterable[str],
+                           digests: Optional[Iterable[Optional[str]]] = None) -> List[object]:
+        """Queue many paths in full batches, return entry ids or exceptions in order"""
+        futures = []
+        for file_path, digest in zip(file_paths, digests if digests is not None else itertools.repeat(None)):
+            futures.append(self._enqueue(file_path, digest))
+            if len(self._pending) >= self.batch_size:
+                await self.flush()
+        await self.flush()
+        return await asyncio.gather(*futures, return_exceptions=True)
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.linger)
+        self._timer = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        """Send everything pending"""
+        while self._pending:
+            batch, self._pending = self._pending[:self.batch_size], self._pending[self.batch_size:]
+            try:
+                pipe = self._client.pipeline(transaction=False)
+                for fields, _ in batch:
+                    pipe.xadd(self.stream, fields, maxlen=self.maxlen, approximate=True)
+                entry_ids = await pipe.execute()
+                for (_, future), entry_id in zip(batch, entry_ids):
+                    if not future.done():
+                        future.set_result(entry_id)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    async def close(self) -> None:
+        """Send what is left before shutdown"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        await self.flush()
+
+file_publisher = StreamPublisher(FILE_STREAM, FILE_STREAM_MAXLEN, PUBLISH_BATCH_SIZE, PUBLISH_LINGER_MS / 1000)
 
 # Load rules
 def load_rules_from_yaml(rule_path: str) -> dict:
     """Load rules from YAML file"""
+    import yaml  # only needed once the rules are first used
     with open(rule_path, 'r') as file:
         return yaml.safe_load(file)
 
-data_rules = load_rules_from_yaml(data_rules_path)
+def decode_span(data: bytes) -> str:
+    """Decode a matched byte span, falling back for non UTF-8 dumps"""
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        if DECODE_FALLBACK_ENCODING:
+            return data.decode(DECODE_FALLBACK_ENCODING, errors=DECODE_ERRORS)
+        return data.decode('utf-8', errors=DECODE_ERRORS)
+
+def _decode_fallback(error: UnicodeDecodeError) -> Tuple[str, int]:
+    """Codec error handler applying the decode_span policy to the bytes of a stream that are not UTF-8"""
+    if DECODE_FALLBACK_ENCODING:
+        data = error.object[error.start:error.end]
+        return data.decode(DECODE_FALLBACK_ENCODING, errors=DECODE_ERRORS), error.end
+    return codecs.lookup_error(DECODE_ERRORS)(error)
+
+codecs.register_error('decode_fallback', _decode_fallback)
+
+def _has_backreference(pattern) -> bool:
+    """Check a pattern for group references, which would point at the wrong group once joined"""
+    try:
+        from re import _parser as sre_parse  # Python 3.11+
+    except ImportError:
+        import sre_parse  # type: ignore
+    references = ('GROUPREF', 'GROUPREF_EXISTS', 'GROUPREF_IGNORE', 'GROUPREF_LOC_IGNORE', 'GROUPREF_UNI_IGNORE')
+
+    def walk(node) -> bool:
+        if isinstance(node, sre_parse.SubPattern):
+            return any(str(op) in references or walk(av) for op, av in node)
+        if isinstance(node, (list, tuple)):
+            return any(walk(item) for item in node)
+        return False
+
+    return walk(sre_parse.parse(pattern))
+
+def _compile_rules(patterns: list) -> Tuple[list, Optional[re.Pattern]]:
+    """Compile rules one by one and as a single named-group alternation"""
+    regexes = [re.compile(pattern) for pattern in patterns]
+    if not patterns or any(_has_backreference(pattern) for pattern in patterns):
+        # Nothing to join, or \1 would refer to another rule's wrapper group
+        return regexes, None
+    joiner = b'|' if isinstance(patterns[0], bytes) else '|'
+    try:
+        combined = re.compile(joiner.join(
+            (f'(?P<_r{i}>'.encode() + pattern + b')') if isinstance(pattern, bytes) else f'(?P<_r{i}>{pattern})'
+            for i, pattern in enumerate(patterns)
+        ))
+    except re.error:
+        # Duplicate group names or inline global flags cannot be joined
+        combined = None
+    return regexes, combined
+
+def _first_rule(text, regexes: list, combined: Optional[re.Pattern]) -> Optional[re.Pattern]:
+    """Return the first rule matching text, in rules file order"""
+    if combined is None:
+        for regex in regexes:
+            if regex.search(text):
+                return regex
+        return None
+
+    hit = combined.search(text)
+    if hit is None:
+        return None
+    index = int(hit.lastgroup[2:])
+    for regex in regexes[:index]:
+        if regex.search(text):
+            return regex
+    return regexes[index]
+
+class RuleEngine:
+    """Compiled line rules matched in a single pass per line.
+
+    All patterns are joined into one alternation of named groups so lines that
+    match no rule (the bulk of any dump) cost a single regex search. When the
+    combined pattern hits, rules ordered before the hit are re-checked so the
+    first matching rule in ``rules.yaml`` still wins, as before.
+
+    Byte versions of the rules let raw file data be matched without decoding
+    it; only matched spans are decoded. Their ``\\s`` and ``\\w`` classes are
+    ASCII-only.
+    """
+
+    def __init__(self, line_rules: List[dict]):
+        self.names = [rule['name'] for rule in line_rules]
+        patterns = [rule['pattern'] for rule in line_rules]
+        self.regexes, self.combined = _compile_rules(patterns)
+        try:
+            self.byte_regexes, self.byte_combined = _compile_rules([p.encode('utf-8') for p in patterns])
+        except re.error:
+            self.byte_regexes, self.byte_combined = None, None
+
+    def _winner(self, text: str) -> Optional[re.Pattern]:
+        """Return the first rule matching text, in rules file order"""
+        return _first_rule(text, self.regexes, self.combined)
+
+    def match_text(self, text: str) -> List[str]:
+        """Return all matches of the first rule that matches text"""
+        regex = self._winner(text)
+        if regex is None:
+            return []
+        return regex.findall(text)
+
+    def match_lines(self, lines: Iterable[str]) -> Iterator[str]:
+        """Yield matches for every stripped line of an iterable"""
+        winner = self._winner
+        for line in lines:
+            line = line.strip()
+            regex = winner(line)
+            if regex is not None:
+                yield from regex.findall(line)
+
+    def match_byte_lines(self, lines: Iterable[bytes]) -> Iterator[str]:
+        """Yield decoded matches for every stripped line of raw bytes"""
+        if self.byte_regexes is None:
+            yield from self.match_lines(decode_span(line) for line in lines)
+            return
+
+        regexes, combined = self.byte_regexes, self.byte_combined
+        for line in lines:
+            line = line.strip()
+            regex = _first_rule(line, regexes, combined)
+            if regex is not None:
+                for match in regex.findall(line):
+                    yield decode_span(match)
+
+class LinkExtractor:
+    """Finds links such as t.me invites and .onion addresses.
+
+    Rules come from LINK_RULES, written as ``- rule1: pattern`` (the
+    ``name``/``pattern`` form of the data rules works too). Each rule is
+    compiled once for str and bytes and run with finditer over a whole
+    block of text rather than line by line; patterns start with a literal
+    such as ``https://``, which the regex engine searches for directly.
+    """
+
+    def __init__(self, line_rules: List[dict]):
+        self.rules = []
+        for rule in line_rules:
+            if 'pattern' in rule:
+                name, pattern = rule.get('name', f'rule{len(self.rules) + 1}'), rule['pattern']
+            else:
+                name, pattern = next(iter(rule.items()))
+            self.rules.append((str(name), re.compile(pattern), re.compile(pattern.encode('utf-8'))))
+
+    def find_text(self, text: str) -> List[Tuple[str, str]]:
+        """Return (rule, link) pairs found in text"""
+        return [(name, match.group(0)) for name, regex, _ in self.rules for match in regex.finditer(text)]
+
+    def find_bytes(self, data: bytes) -> List[Tuple[str, str]]:
+        """Return (rule, link) pairs found in a block of raw lines"""
+        return [(name, decode_span(match.group(0)))
+                for name, _, regex in self.rules for match in regex.finditer(data)]
+
+class RuleSet:
+    """Data and link rules compiled together, versioned by a hash of their files"""
+
+    def __init__(self, version: str, engine: RuleEngine, extractor: Optional[LinkExtractor]):
+        self.version = version
+        self.engine = engine
+        self.extractor = extractor
+
+def _file_signature(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+    except OSError:
+        return None
+
+class RuleRegistry:
+    """Current rule set, swapped atomically when the rules files change.
+
+    Work takes ``current()`` once per message, stream or chunk and keeps that
+    rule set to the end, so a reload neither pauses nor mixes rules within a
+    unit of work. ``reload`` compiles the new set off to the side and only
+    replaces the reference once it compiled; a broken rules file is logged
+    and the previous set stays in use. The version is a hash of the rules
+    files, so every worker and process loading the same files agrees on it.
+    """
+
+    def __init__(self, data_path: str, link_path: str):
+        self.data_path = data_path
+        self.link_path = link_path if links_enabled else ''
+        self._lock = threading.Lock()
+        self._current: Optional[RuleSet] = None
+        self._signatures = None
+
+    def _signature(self) -> tuple:
+        return _file_signature(self.data_path), _file_signature(self.link_path) if self.link_path else None
+
+    def _load(self) -> RuleSet:
+        import yaml  # only needed once the rules are first used
+        sha = hashlib.sha256()
+        with open(self.data_path, 'rb') as f:
+            data_source = f.read()
+        sha.update(data_source)
+        extractor = None
+        if self.link_path:
+            with open(self.link_path, 'rb') as f:
+                link_source = f.read()
+            sha.update(b'\0' + link_source)
+            extractor = LinkExtractor(yaml.safe_load(link_source)['line_rules'])
+        engine = RuleEngine(yaml.safe_load(data_source)['line_rules'])
+        return RuleSet(sha.hexdigest()[:12], engine, extractor)
+
+    def current(self) -> RuleSet:
+        """Return the rule set in use, loading it on first use"""
+        rule_set = self._current
+        if rule_set is None:
+            rule_set = self.reload(force=True)
+        return rule_set
+
+    def reload(self, force: bool = False) -> RuleSet:
+        """Recompile the rules if their files changed (or always when forced) and swap them in"""
+        with self._lock:
+            signatures = self._signature()
+            if self._current is not None and not force and signatures == self._signatures:
+                return self._current
+            self._signatures = signatures
+            try:
+                rule_set = self._load()
+            except Exception as e:
+                if self._current is None:
+                    raise
+                log_error(f'Error reloading rules, keeping rule set {self._current.version}: {e}',
+                          rules_version=self._current.version)
+                return self._current
+            previous, self._current = self._current, rule_set
+            if previous is not None and previous.version != rule_set.version:
+                log_info(f'Rule set {previous.version} replaced by {rule_set.version}', rules_version=rule_set.version)
+            return rule_set
+
+    def require(self, version: str) -> RuleSet:
+        """Return the rule set with the given version, reloading once if this process is behind"""
+        rule_set = self.current()
+        if rule_set.version != version:
+            rule_set = self.reload(force=True)
+        return rule_set
+
+rule_sets = RuleRegistry(data_rules_path, link_rules_path)
+
+async def watch_rules(redis_client, shutdown_event: asyncio.Event) -> None:
+    """Reload the rules when their files change or a message arrives on RULES_CHANNEL"""
+    loop = asyncio.get_event_loop()
+    pubsub = None
+    while not shutdown_event.is_set():
+        force = False
+        try:
+            if pubsub is None:
+                pubsub = redis_client.pubsub()
+                await pubsub.subscribe(RULES_CHANNEL)
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=RULES_CHECK_INTERVAL)
+            if message is not None:
+                log_info(f'Rules reload requested: {message["data"]}')
+                force = True
+        except Exception as e:
+            log_error(f'Rules control channel error: {e}')
+            pubsub = None
+            try:
+                await asyncio.wait_for(shutdown_event.wait(), timeout=RULES_CHECK_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+        # Compile off the event loop; work in flight keeps the set it started with
+        await loop.run_in_executor(None, rule_sets.reload, force)
+    if pubsub is not None:
+        try:
+            await pubsub.close()
+        except Exception:
+            pass
 
 # Logging functions
-def write_log(file_path: str, log: str) -> None:
-    """Write log to file if path exists"""
-    if os.path.exists(file_path):
-        with open(file_path, 'a') as f:
-            f.write(f'{log}\n')
+class AsyncLogWriter:
+    """Background thread that writes log lines in batches.
+
+    Callers only put lines on a queue, so logging never blocks the event
+    loop on file I/O. The thread drains up to ``BATCH_SIZE`` lines at a time,
+    writes them per file with one call, echoes them to the console and
+    rotates a file once it passes ``max_bytes`` or ``rotate_interval``
+    seconds, keeping ``backup_count`` old copies.
+    """
+
+    BATCH_SIZE = 1000
+
+    def __init__(self, max_bytes: int, backup_count: int, rotate_interval: int):
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.rotate_interval = rotate_interval
+        # SimpleQueue.put is reentrant, so signal handlers can log too
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._files: dict = {}
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+
+    def submit(self, path: Optional[str], line: str, echo: str = '') -> None:
+        """Queue a line for path (None for console only) and its console text"""
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+                    self._thread.start()
+        self._queue.put((path, line, echo))
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = None in batch
+            lines_by_path: dict = {}
+            console = []
+            for item in batch:
+                if item is None:
+                    continue
+                path, line, echo = item
+                if path:
+                    lines_by_path.setdefault(path, []).append(line)
+                if echo:
+                    console.append(echo)
+
+            for path, lines in lines_by_path.items():
+                try:
+                    self._write(path, '\n'.join(lines) + '\n')
+                except Exception as e:
+                    console.append(f'Error writing log {path}: {e}')
+            if console:
+                sys.stdout.write('\n'.join(console) + '\n')
+                sys.stdout.flush()
+
+            if stop:
+                for handle in self._files.values():
+                    handle['file'].close()
+                self._files.clear()
+                return
+
+    def _write(self, path: str, data: str) -> None:
+        handle = self._files.get(path)
+        if handle is not None and (handle['size'] >= self.max_bytes
+                                   or time.monotonic() - handle['opened'] >= self.rotate_interval):
+            self._rotate(path)
+            handle = None
+        if handle is None:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            f = open(path, 'a', encoding='utf-8')
+            handle = {'file': f, 'size': f.tell(), 'opened': time.monotonic()}
+            self._files[path] = handle
+        handle['file'].write(data)
+        handle['file'].flush()
+        handle['size'] += len(data)
+
+    def _rotate(self, path: str) -> None:
+        self._files.pop(path)['file'].close()
+        if self.backup_count <= 0:
+            os.remove(path)
+            return
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f'{path}.{i}'):
+                os.replace(f'{path}.{i}', f'{path}.{i + 1}')
+        os.replace(path, f'{path}.1')
+
+    def close(self) -> None:
+        """Write everything still queued and stop the thread"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+log_writer = AsyncLogWriter(log_max_bytes, log_backup_count, log_rotate_interval)
+atexit.register(log_writer.close)
+log_context: dict = {}
+
+def set_log_context(**fields) -> None:
+    """Set fields added to every log line of this process, e.g. worker"""
+    log_context.update(fields)
+
+def _format_log(level: str, message: str, fields: dict) -> str:
+    parts = [datetime.now().isoformat(timespec='milliseconds'), f'level={level}']
+    for key, value in {**log_context, **fields}.items():
+        if value is None:
+            continue
+        value = str(value)
+        if not value or ' ' in value or '"' in value or '=' in value:
+            value = json.dumps(value, ensure_ascii=False)
+        parts.append(f'{key}={value}')
+    parts.append(f'msg={json.dumps(message, ensure_ascii=False)}')
+    return ' '.join(parts)
+
+def log_info(message: str, **fields) -> None:
+    """Log an event to the run log and the console"""
+    log_writer.submit(log_file_run, _format_log('info', message, fields), message)
+
+def log_error(message: str, **fields) -> None:
+    """Log an error to the error log and the console"""
+    log_writer.submit(log_file_error, _format_log('error', message, fields), message)
+
+def close_logging() -> None:
+    """Flush queued log lines and stop the writer thread"""
+    log_writer.close()
+
+# Dist output
+def tag_records(records: Iterable[str], version: str) -> List[str]:
+    """Append the rule set version to records as a tab separated field"""
+    return [f'{record}\t{version}' for record in records]
+
+def encode_records(records: List[str]) -> bytes:
+    """Encode records as newline terminated dist lines"""
+    return ('\n'.join(records) + '\n').encode('utf-8', errors='surrogateescape')
+
+class DailyOutputWriter:
+    """Long-lived buffered sink for the daily dist file.
+
+    The file for the current day stays open between writes and is swapped for
+    a new one after midnight. Buffered data is flushed once ``flush_bytes``
+    have been written or ``flush_interval`` seconds have passed, and on close.
+    Writes are serialised with a lock, in batches, so concurrent producers
+    never interleave partial lines.
+    """
+
+    BATCH_SIZE = 4096
+
+    def __init__(self, directory: str, buffer_size: int, flush_bytes: int, flush_interval: float):
+        self.directory = directory
+        self.buffer_size = buffer_size
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._file = None
+        self._day: Optional[date] = None
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+    def _ensure_open(self) -> None:
+        """Open today's file, rotating away from yesterday's one"""
+        today = date.today()
+        if self._file is not None and self._day == today:
+            return
+        if self._file is not None:
+            self._file.close()
+        os.makedirs(self.directory, exist_ok=True)
+        self._file = open(os.path.join(self.directory, f'{today}.txt'), 'ab', buffering=self.buffer_size)
+        self._day = today
+
+    def _flush_locked(self) -> None:
+        if self._file is not None:
+            self._file.flush()
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+    def write_many(self, records: Iterable[str]) -> int:
+        """Append records to the daily file, return how many were written"""
+        written = 0
+        records = iter(records)
+        while True:
+            batch = list(itertools.islice(records, self.BATCH_SIZE))
+            if not batch:
+                break
+            data = encode_records(batch)
+            with self._lock:
+                self._ensure_open()
+                self._file.write(data)
+                self._pending += len(data)
+                if self._pending >= self.flush_bytes:
+                    self._flush_locked()
+            written += len(batch)
+        self.flush_if_due()
+        return written
+
+    def write_block(self, data: bytes, before_write: Callable[[str, int], None]) -> None:
+        """Append one contiguous block and flush it.
+
+        ``before_write`` is called with the dist path and the offset the block
+        will start at while the lock is held, so callers can persist a write
+        intent that no other producer can race.
+        """
+        with self._lock:
+            self._ensure_open()
+            before_write(self._file.name, self._file.tell())
+            self._file.write(data)
+            self._flush_locked()
+
+    def flush_if_due(self) -> None:
+        """Flush buffered data if the time threshold has passed"""
+        with self._lock:
+            if self._pending and time.monotonic() - self._last_flush >= self.flush_interval:
+                self._flush_locked()
+
+    def flush(self) -> None:
+        """Flush buffered data to disk"""
+        with self._lock:
+            self._flush_locked()
+
+    def close(self) -> None:
+        """Flush and close the daily file"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+                self._day = None
+            self._pending = 0
+
+dist_writer = DailyOutputWriter(dist_dir, dist_buffer_size, dist_flush_bytes, dist_flush_interval)
+
+def _native_key(key: bytes) -> int:
+    """Key as the native-endian int memoryview.cast('Q') yields for shard files"""
+    return int.from_bytes(key, sys.byteorder)
+
+def record_key(record: str) -> bytes:
+    """64-bit dedup key of a dist record"""
+    return hashlib.blake2b(record.encode('utf-8', errors='surrogateescape'), digest_size=8).digest()
+
+class RecordDeduplicator:
+    """Memory-bounded, persistent set of records already written to dist.
+
+    Records are reduced to 64-bit keys. A Bloom filter answers "never seen"
+    for most new records without touching disk; when it says "maybe", the
+    key is checked exactly against sharded key files, of which only a few
+    are cached in memory. New keys are buffered and appended to their shard
+    after the dist file has been flushed, so a crash can re-emit records but
+    never drops them. The scope is either ``daily`` or ``all`` time.
+    """
+
+    KEY_SIZE = 8
+    SAVE_INTERVAL = 60
+
+    def __init__(self, directory: str, scope: str, bloom_bits: int, hashes: int, shards: int, cached_shards: int):
+        self.directory = directory
+        self.scope = scope
+        self.bloom_bits = bloom_bits
+        self.hashes = hashes
+        self.shards = shards
+        self.cached_shards = cached_shards
+        self._lock = threading.Lock()
+        self._state_dir: Optional[str] = None
+        self._bloom = bytearray()
+        self._cache: OrderedDict = OrderedDict()
+        self._unsaved: dict = {}
+        self._claimed: set = set()
+        self._last_save = time.monotonic()
+        self.stats = {'records': 0, 'duplicates': 0}
+
+    def _current_dir(self) -> str:
+        name = 'all' if self.scope == 'all' else str(date.today())
+        return os.path.join(self.directory, name)
+
+    def _bloom_path(self) -> str:
+        return os.path.join(self._state_dir, 'bloom.bin')
+
+    def _shard_path(self, shard: int) -> str:
+        return os.path.join(self._state_dir, f'{shard:05d}.keys')
+
+    def _ensure_state(self) -> None:
+        """Load the state for the current scope, switching days if needed"""
+        state_dir = self._current_dir()
+        if state_dir == self._state_dir:
+            return
+        if self._state_dir is not None:
+            self._save_locked()
+        self._state_dir = state_dir
+        self._cache.clear()
+        self._unsaved = {}
+        os.makedirs(state_dir, exist_ok=True)
+        if self.scope != 'all':
+            self._prune_days(state_dir)
+
+        size = self.bloom_bits // 8
+        try:
+            with open(self._bloom_path(), 'rb') as f:
+                self._bloom = bytearray(f.read())
+        except OSError:
+            self._bloom = bytearray()
+        if len(self._bloom) != size:
+            # Missing or resized filter, rebuild it from the exact key files
+            self._bloom = bytearray(size)
+            for shard in range(self.shards):
+                data = self._shard_data(shard)
+                for i in range(0, len(data), self.KEY_SIZE):
+                    self._bloom_add(int.from_bytes(data[i:i + self.KEY_SIZE], 'big'))
+
+    def _prune_days(self, keep: str) -> None:
+        """Remove the state of past days, a daily scope never looks at it again"""
+        today = os.path.basename(keep)
+        for name in os.listdir(self.directory):
+            try:
+                past = date.fromisoformat(name) < date.fromisoformat(today)
+            except ValueError:
+                continue
+            if past:
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+    def _shard_data(self, shard: int) -> bytes:
+        try:
+            with open(self._shard_path(shard), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return b''
+        return data[:len(data) - len(data) % self.KEY_SIZE]
+
+    def _shard_keys(self, shard: int) -> set:
+        """Return the exact keys of a shard as native ints, through a small LRU cache"""
+        keys = self._cache.get(shard)
+        if keys is None:
+            # One C-level pass over the file instead of a slice per key
+            keys = set(memoryview(self._shard_data(shard)).cast('Q'))
+            keys.update(_native_key(key) for key in self._unsaved.get(shard, ()))
+            self._cache[shard] = keys
+            if len(self._cache) > self.cached_shards:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(shard)
+        return keys
+
+    def _bloom_positions(self, value: int) -> Iterator[int]:
+        h1, h2 = value >> 32, (value & 0xFFFFFFFF) | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.bloom_bits
+
+    def _bloom_add(self, value: int) -> None:
+        bloom = self._bloom
+        for bit in self._bloom_positions(value):
+            bloom[bit >> 3] |= 1 << (bit & 7)
+
+    def _bloom_contains(self, value: int) -> bool:
+        bloom = self._bloom
+        return all(bloom[bit >> 3] & (1 << (bit & 7)) for bit in self._bloom_positions(value))
+
+    def claim(self, records: List[str], keys: Optional[List[bytes]] = None) -> Tuple[List[str], List[bytes]]:
+        """Return records not seen or claimed before with their keys, claiming them.
+
+        Claimed keys count as seen for other producers until ``commit`` marks
+        them seen once their records are written, or ``release`` hands them
+        back when the write failed. Keys may be computed beforehand with
+        record_key, e.g. in the process that matched the records.
+        """
+        if keys is None:
+            keys = [record_key(record) for record in records]
+        new_records, new_keys = [], []
+        with self._lock:
+            self._ensure_state()
+            claimed = self._claimed
+
+            # Bloom misses are new for sure; the maybes are grouped by shard so
+            # each shard is looked up once per batch rather than once per record
+            maybe: dict = {}
+            for key in keys:
+                value = int.from_bytes(key, 'big')
+                if key not in claimed and self._bloom_contains(value):
+                    maybe.setdefault(value % self.shards, []).append(key)
+            known = set()
+            for shard, shard_probes in maybe.items():
+                shard_keys = self._shard_keys(shard)
+                known.update(key for key in shard_probes if _native_key(key) in shard_keys)
+
+            for record, key in zip(records, keys):
+                if key in claimed or key in known:
+                    self.stats['duplicates'] += 1
+                    continue
+                claimed.add(key)
+                new_records.append(record)
+                new_keys.append(key)
+        return new_records, new_keys
+
+    def commit(self, keys: List[bytes]) -> None:
+        """Mark claimed keys as seen after their records were written"""
+        with self._lock:
+            self._ensure_state()
+            for key in keys:
+                self._claimed.discard(key)
+                value = int.from_bytes(key, 'big')
+                shard = value % self.shards
+                self._bloom_add(value)
+                self._unsaved.setdefault(shard, set()).add(key)
+                if shard in self._cache:
+                    self._cache[shard].add(_native_key(key))
+            self.stats['records'] += len(keys)
+
+    def release(self, keys: List[bytes]) -> None:
+        """Give back claimed keys whose records could not be written"""
+        with self._lock:
+            self._claimed.difference_update(keys)
+
+    def _save_locked(self) -> None:
+        for shard, keys in self._unsaved.items():
+            with open(self._shard_path(shard), 'ab') as f:
+                f.write(b''.join(keys))
+        self._unsaved = {}
+        if self._state_dir is not None and self._bloom:
+            tmp_path = self._bloom_path() + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(self._bloom)
+            os.replace(tmp_path, self._bloom_path())
+        self._last_save = time.monotonic()
+
+    def flush(self, force: bool = False) -> None:
+        """Persist new keys; call only after the dist file has been flushed"""
+        with self._lock:
+            if self._state_dir is None:
+                return
+            if force or time.monotonic() - self._last_save >= self.SAVE_INTERVAL:
+                self._save_locked()
+
+record_dedup = RecordDeduplicator(dedup_dir, dedup_scope, dedup_bloom_bits, dedup_hashes,
+                                  dedup_shards, dedup_cached_shards) if dedup_enabled else None
+
+def claim_records(records: List[str], keys: Optional[List[bytes]] = None) -> Tuple[List[str], List[bytes]]:
+    """Drop records already written to dist within the dedup scope, claiming the rest"""
+    if record_dedup is None:
+        return records, []
+    return record_dedup.claim(records, keys)
+
+def finish_records(keys: List[bytes], written: bool) -> None:
+    """Mark claimed records as seen once written, or release them after a failed write"""
+    if record_dedup is None or not keys:
+        return
+    if written:
+        record_dedup.commit(keys)
+    else:
+        record_dedup.release(keys)
+
+def close_outputs() -> None:
+    """Flush and close dist output, then persist the dedup state"""
+    dist_writer.close()
+    if record_dedup is not None:
+        record_dedup.flush(force=True)
+
+async def flush_dist_periodically(shutdown_event: asyncio.Event) -> None:
+    """Flush the dist writer on its time threshold until shutdown"""
+    while not shutdown_event.is_set():
+        try:
+            await asyncio.wait_for(shutdown_event.wait(), timeout=dist_flush_interval)
+        except asyncio.TimeoutError:
+            pass
+        dist_writer.flush_if_due()
+        if record_dedup is not None:
+            # New keys may only be persisted once their records are on disk
+            dist_writer.flush()
+            record_dedup.flush()
+    close_outputs()
 
 # Data processing functions
-def get_data_from_text(message_text: str) -> None:
-    """Extract data from text using regex rules"""
-    for rule in data_rules['line_rules']:
-        regex = re.compile(rule['pattern'])
-        matches = regex.findall(message_text)
-        if matches:
-            path_today = f'{dist_dir}/{date.today()}.txt'
-            if not os.path.exists(path_today):
-                with open(path_today, 'w') as f:
-                    f.write('')
-            with open(path_today, 'a') as f:
-                for match in matches:
-                    f.write(f'{match}\n')
+def write_matches(matches: Iterable[str], version: str) -> int:
+    """Append new matches to today's dist file, tagged with the rule set version"""
+    written = 0
+    matches = iter(matches)
+    while True:
+        batch = list(itertools.islice(matches, DailyOutputWriter.BATCH_SIZE))
+        if not batch:
             break
+        records, keys = claim_records(batch)
+        try:
+            written += dist_writer.write_many(tag_records(records, version))
+        except BaseException:
+            finish_records(keys, False)
+            raise
+        finish_records(keys, True)
+    return written
+
+def get_data_from_text(message_text: str, source: str = 'telegram') -> None:
+    """Extract data and links from text using regex rules"""
+    rule_set = rule_sets.current()
+    matches = rule_set.engine.match_text(message_text)
+    if matches:
+        write_matches(matches, rule_set.version)
+    if rule_set.extractor is not None:
+        record_links(rule_set.extractor.find_text(message_text), source)
 
 # File validation functions
-def check_valid_file_extension(file: str) -> bool:
-    """Check if file extension is in whitelist"""
+# Content types the reader can sniff and handle whatever the file is called
+WHITELIST_MIME_TYPES = (
+    'text/', 'application/zip', 'application/x-zip-compressed', 'application/vnd.rar', 'application/x-rar-compressed',
+    'application/x-7z-compressed', 'application/x-tar', 'application/gzip', 'application/x-gzip',
+    'application/x-bzip2', 'application/x-xz', 'application/csv',
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+)
+
+def check_valid_file_extension(file: str, mime_type: Optional[str] = None) -> bool:
+    """Check if file extension is in whitelist or its declared content type is one the reader handles"""
     _, file_extension = os.path.splitext(file)
-    return file_extension in white_file_types
+    if file_extension in white_file_types:
+        return True
+    return bool(mime_type) and mime_type.lower().startswith(WHITELIST_MIME_TYPES)
+
+class DownloadHistory:
+    """Indexed view of the append-only download history file.
+
+    Keys are ``<size>-<file name>``; lines in the history file are download
+    paths whose base name is that key. The file is read once into a set, so
+    lookups are O(1) and exact. ``claim`` reserves a key before a download
+    starts so clients seeing the same document at once don't both fetch it.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._keys: Optional[set] = None
+        self._claimed: set = set()
+
+    @staticmethod
+    def make_key(size: int, file_name: str) -> str:
+        return str(size) + '-' + file_name
+
+    def _load(self) -> set:
+        if self._keys is None:
+            keys = set()
+            if os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        line = line.strip()
+                        if line:
+                            keys.add(os.path.basename(line))
+            self._keys = keys
+        return self._keys
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._load() or key in self._claimed
+
+    def claim(self, key: str) -> bool:
+        """Reserve key for download, False if it is known or already claimed"""
+        with self._lock:
+            if key in self._load() or key in self._claimed:
+                return False
+            self._claimed.add(key)
+            return True
+
+    def release(self, key: str) -> None:
+        """Drop a claim after a failed download"""
+        with self._lock:
+            self._claimed.discard(key)
+
+    def mark(self, entry: str) -> None:
+        """Record a finished download path in the index and history file"""
+        key = os.path.basename(entry)
+        with self._lock:
+            self._load().add(key)
+            self._claimed.discard(key)
+            append_line_to_file(self.path, entry)
+
+download_history = DownloadHistory(history_downloaded)
+
+# Content-addressed deduplication
+class ContentIndex:
+    """Persistent set of SHA-256 digests of file content already scanned.
+
+    Digests are kept in memory and appended to a shared log, so the listener
+    and the reader see each other's entries. Lines appended by the other
+    worker are picked up incrementally before each lookup.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._digests: set = set()
+        self._offset = 0
+        self.stats = {'duplicates': 0, 'bytes_skipped': 0}
+
+    def _refresh(self) -> None:
+        """Read digests appended since the last lookup"""
+        try:
+            if os.path.getsize(self.path) == self._offset:
+                return
+            with open(self.path, 'r', encoding='utf-8') as f:
+                f.seek(self._offset)
+                for line in f:
+                    if line.endswith('\n'):
+                        self._digests.add(line.strip())
+                        self._offset += len(line.encode('utf-8'))
+                    else:
+                        break
+        except OSError:
+            pass
+
+    def _add_locked(self, digest: str) -> None:
+        self._digests.add(digest)
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        append_line_to_file(self.path, digest)
+
+    def seen(self, digest: str, size: int) -> bool:
+        """Check if the content was scanned before, without adding it"""
+        with self._lock:
+            self._refresh()
+            if digest in self._digests:
+                self.stats['duplicates'] += 1
+                self.stats['bytes_skipped'] += size
+                return True
+            return False
+
+    def add(self, digest: str) -> None:
+        """Add digest once its content has been scanned"""
+        with self._lock:
+            self._refresh()
+            if digest not in self._digests:
+                self._add_locked(digest)
+
+content_index = ContentIndex(content_index_file)
+
+class LinkIndex:
+    """Persistent set of discovered links, indexed by rule.
+
+    New links are appended to ``<dir>/<rule>.txt`` as tab separated link,
+    first-seen time and source. Those files are the dedup set as well:
+    they are read into memory on first use and lines appended by other
+    workers are picked up incrementally before each batch.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._links: set = set()
+        self._offsets: dict = {}
+        self.stats = {'new': 0, 'seen': 0}
+
+    def _refresh(self) -> None:
+        try:
+            names = [name for name in os.listdir(self.directory) if name.endswith('.txt')]
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.directory, name)
+            offset = self._offsets.get(path, 0)
+            try:
+                if os.path.getsize(path) == offset:
+                    continue
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    for line in f:
+                        if not line.endswith(b'\n'):
+                            break
+                        self._links.add(line.split(b'\t', 1)[0].decode('utf-8', 'replace'))
+                        offset += len(line)
+            except OSError:
+                continue
+            self._offsets[path] = offset
+
+    def add(self, links: Iterable[Tuple[str, str]], source: str) -> int:
+        """Record links not seen before, return how many were new"""
+        with self._lock:
+            self._refresh()
+            by_rule: dict = {}
+            for rule, link in links:
+                if link in self._links:
+                    self.stats['seen'] += 1
+                    continue
+                self._links.add(link)
+                by_rule.setdefault(rule, []).append(link)
+            if not by_rule:
+                return 0
+
+            os.makedirs(self.directory, exist_ok=True)
+            seen_at = datetime.now().isoformat(timespec='seconds')
+            source = source.replace('\t', ' ').replace('\n', ' ')
+            added = 0
+            for rule, rule_links in by_rule.items():
+                path = os.path.join(self.directory, f'{rule}.txt')
+                data = ''.join(f'{link}\t{seen_at}\t{source}\n' for link in rule_links).encode('utf-8')
+                with open(path, 'ab') as f:
+                    f.write(data)
+                # Own appends are already in memory, skip them on the next refresh
+                if self._offsets.get(path, 0) == os.path.getsize(path) - len(data):
+                    self._offsets[path] = os.path.getsize(path)
+                added += len(rule_links)
+            self.stats['new'] += added
+            return added
+
+link_index = LinkIndex(links_dir)
+
+def record_links(links: List[Tuple[str, str]], source: str) -> int:
+    """Store newly discovered links, logging each one"""
+    if not links:
+        return 0
+    try:
+        added = link_index.add(links, source)
+        if added:
+            log_info(f'Discovered {added} new links in {source}', source=source, links=added)
+        return added
+    except Exception as e:
+        log_error(f'Error recording links from {source}: {e}', source=source)
+        return 0
+
+def hash_stream(stream: IO[bytes]) -> Tuple[str, int]:
+    """Return the SHA-256 digest and size of a binary stream"""
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in iter(lambda: stream.read(STREAM_READ_SIZE), b''):
+        digest.update(chunk)
+        size += len(chunk)
+    return digest.hexdigest(), size
+
+def hash_file(file_path: str) -> Tuple[str, int]:
+    """Return the SHA-256 digest and size of a file"""
+    with open(file_path, 'rb') as f:
+        return hash_stream(f)
+
+class HashingWriter:
+    """Binary file writer that hashes content as it is written"""
+
+    def __init__(self, file_path: str):
+        self.name = file_path
+        self.size = 0
+        self._digest = hashlib.sha256()
+        self._file = open(file_path, 'wb')
+
+    def write(self, data: bytes) -> int:
+        self._digest.update(data)
+        self.size += len(data)
+        return self._file.write(data)
 
-def check_file_in_history(size: int, file_name: str) -> bool:
+    def flush(self) -> None:
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+    def hexdigest(self) -> str:
+        return self._digest.hexdigest()
+
+def log_duplicate_content(file_path: str, size: int) -> None:
+    """Report content skipped by the content index"""
+    log_info(f'Skipping duplicate content {file_path} ({size} bytes), '
+             f'{content_index.stats["bytes_skipped"]} bytes of scanning avoided so far',
+             file=file_path, size=size)
+
+def check_file_in_history(size: int, file_name: str, mime_type: Optional[str] = None) -> bool:
     """Check if file has been processed before"""
-    if not check_valid_file_extension(file_name):
+    if not check_valid_file_extension(file_name, mime_type):
         return True
     if size == 0 or file_name == '':
         return True
 
     try:
-        tmp_path = str(size) + '-' + file_name
-        if not os.path.exists(history_downloaded):
-            return False
-
-        with open(history_downloaded, 'r', encoding='utf-8') as f:
-            content = f.read()
-            return tmp_path in content
+        return DownloadHistory.make_key(size, file_name) in download_history
     except Exception as e:
-        error_msg = f'Error checking file existence: {str(e)}'
-        print(error_msg)
-        write_log(log_file_error, f'{error_msg}\n')
+        log_error(f'Error checking file existence: {str(e)}')
         return True
 
+def claim_file_download(size: int, file_name: str, mime_type: Optional[str] = None) -> bool:
+    """Atomically check history and reserve file for download"""
+    if check_file_in_history(size, file_name, mime_type):
+        return False
+    return download_history.claim(DownloadHistory.make_key(size, file_name))
+
+def release_file_download(size: int, file_name: str) -> None:
+    """Release a download reservation so the file can be retried"""
+    download_history.release(DownloadHistory.make_key(size, file_name))
+
 # History management
 def append_line_to_file(history_file: str, file_name: str) -> None:
     """Add file to history"""
@@ -93,43 +1234,277 @@ def append_line_to_file(history_file: str, file_name: str) -> None:
         with open(history_file, 'a', encoding='utf-8') as f:
             f.write(f'{file_name}\n')
     except Exception as e:
-        error_msg = f'Error marking file download: {str(e)}'
-        print(error_msg)
-        write_log(log_file_error, f'{error_msg}\n')
+        log_error(f'Error marking file download: {str(e)}')
+
+# Download progress
+PROGRESS_INTERVAL = float(os.getenv('PROGRESS_INTERVAL', '10'))
+PROGRESS_STEP = float(os.getenv('PROGRESS_STEP', '10'))
+
+class DownloadProgress:
+    """Aggregated state of running downloads.
 
-# Progress callback for downloads
-async def progress_callback(current: int, total: int) -> None:
-    """Progress callback for file downloads"""
-    percentage = (current / total) * 100
-    print(f'{current}/{total} bytes ({percentage:.2f}%)')
-    write_log(log_file_run, f'{current}/{total} bytes ({percentage:.2f}%) (shared_utils.py:progress_callback)\n')
+    Progress callbacks only update in-memory counters. A line is printed at
+    most every ``interval`` seconds per download and only after progress has
+    moved by ``step`` percent; everything else is read through snapshot().
+    """
+
+    def __init__(self, interval: float, step: float):
+        self.interval = interval
+        self.step = step
+        self._downloads: dict = {}
+
+    def track(self, name: str, total: int, client_id: Optional[int] = None) -> Callable[[int, int], None]:
+        """Register a download and return its progress callback"""
+        now = time.monotonic()
+        state = {
+            'name': name,
+            'client_id': client_id,
+            'current': 0,
+            'total': total,
+            'started': now,
+            'reported_at': now,
+            'reported_percentage': 0.0
+        }
+        self._downloads[name] = state
+
+        def callback(current: int, total: int) -> None:
+            state['current'] = current
+            state['total'] = total
+            now = time.monotonic()
+            percentage = (current / total) * 100 if total else 0.0
+            if (now - state['reported_at'] >= self.interval
+                    and percentage - state['reported_percentage'] >= self.step):
+                state['reported_at'] = now
+                state['reported_percentage'] = percentage
+                log_info(f'{name}: {current}/{total} bytes ({percentage:.2f}%)', file=name, client_id=client_id)
+
+        return callback
+
+    def finish(self, name: str) -> None:
+        """Forget a finished or failed download"""
+        self._downloads.pop(name, None)
+
+    def snapshot(self) -> List[dict]:
+        """Return bytes, rate (bytes/s) and ETA (s) of running downloads"""
+        now = time.monotonic()
+        result = []
+        for state in list(self._downloads.values()):
+            elapsed = max(now - state['started'], 1e-6)
+            rate = state['current'] / elapsed
+            remaining = max(state['total'] - state['current'], 0)
+            result.append({
+                'name': state['name'],
+                'client_id': state['client_id'],
+                'current': state['current'],
+                'total': state['total'],
+                'rate': rate,
+                'eta': remaining / rate if rate else None
+            })
+        return result
+
+download_progress = DownloadProgress(PROGRESS_INTERVAL, PROGRESS_STEP)
 
 # File processing functions
+_process_pool: Optional[ProcessPoolExecutor] = None
+
+def get_process_pool() -> Optional[ProcessPoolExecutor]:
+    """Return the shared process pool, None when disabled"""
+    global _process_pool
+    if _process_pool is None and PROCESS_POOL_WORKERS > 0:
+        # Forking would copy locks held by the log writer or rules reload threads
+        import multiprocessing
+        _process_pool = ProcessPoolExecutor(max_workers=PROCESS_POOL_WORKERS,
+                                            mp_context=multiprocessing.get_context('forkserver'))
+    return _process_pool
+
+def shutdown_process_pool() -> None:
+    """Stop the shared process pool"""
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=True)
+        _process_pool = None
+
+def split_file_ranges(file_path: str, chunk_size: int, start: int = 0) -> List[Tuple[int, int]]:
+    """Split a file into byte ranges of about chunk_size ending on newlines"""
+    size = os.path.getsize(file_path)
+    ranges = []
+    with open(file_path, 'rb') as f:
+        while start < size:
+            end = min(start + chunk_size, size)
+            if end < size:
+                f.seek(end)
+                f.readline()
+                end = f.tell()
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+def match_file_range(file_path: str, start: int, end: int,
+                     version: str) -> Tuple[List[str], Optional[List[bytes]], List[Tuple[str, str]], str]:
+    """Return rule matches, their dedup keys, links and the rule set version used for one byte range of a text file"""
+    with open(file_path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            data = mm[start:end]
+    # Pool processes hold their own copy of the rules, catch up with the caller's
+    rule_set = rule_sets.require(version)
+    links = rule_set.extractor.find_bytes(data) if rule_set.extractor is not None else []
+    matches = list(rule_set.engine.match_byte_lines(data.split(b'\n')))
+    # Hash here so the parent only probes the dedup set
+    record_keys = [record_key(match) for match in matches] if dedup_enabled else None
+    return matches, record_keys, links, rule_set.version
+
+class FileCheckpoints:
+    """Per-file byte offsets that let large text files resume after a restart.
+
+    A checkpoint is keyed by path, size and mtime, so a replaced file starts
+    over. Before a chunk's matches are written to dist, a pending intent with
+    the dist path, offset and length is saved; after the write the offset
+    moves past the chunk. On resume, a pending chunk whose bytes are already
+    in dist is not written again, so matches are neither lost nor duplicated.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def key_for(self, file_path: str) -> str:
+        stat = os.stat(file_path)
+        raw = f'{os.path.abspath(file_path)}:{stat.st_size}:{stat.st_mtime_ns}'
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.json')
+
+    def load(self, key: str) -> dict:
+        """Return the saved state, or a fresh one"""
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'offset': 0, 'pending': None}
+
+    def save(self, key: str, state: dict) -> None:
+        """Atomically replace the saved state"""
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = self._path(key) + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self._path(key))
+
+    def clear(self, key: str) -> None:
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    @staticmethod
+    def already_written(pending: dict, data: bytes) -> bool:
+        """Check if a pending chunk made it into dist before the restart"""
+        try:
+            with open(pending['dist'], 'rb') as f:
+                f.seek(pending['position'])
+                return f.read(len(data)) == data
+        except OSError:
+            return False
+
+file_checkpoints = FileCheckpoints(checkpoint_dir)
+
+def commit_chunk(key: str, start: int, end: int, matches: List[str], record_keys: Optional[List[bytes]],
+                 pending: Optional[dict], version: str) -> None:
+    """Write a chunk's matches to dist and move the checkpoint past it"""
+    matches, record_keys = claim_records(matches, record_keys)
+    try:
+        if matches:
+            data = encode_records(tag_records(matches, version))
+            if not (pending and pending['start'] == start and FileCheckpoints.already_written(pending, data)):
+                def save_intent(dist: str, position: int) -> None:
+                    file_checkpoints.save(key, {'offset': start, 'pending': {
+                        'start': start, 'end': end, 'dist': dist, 'position': position, 'length': len(data)
+                    }})
+                dist_writer.write_block(data, save_intent)
+    except BaseException:
+        finish_records(record_keys, False)
+        raise
+    finish_records(record_keys, True)
+    file_checkpoints.save(key, {'offset': end, 'pending': None})
+
 async def read_file_txt(file_path: str) -> Optional[str]:
-    """Read and process text file"""
-    print(f'Reading file {file_path}')
+    """Read and process text file in parallel chunks off the event loop"""
+    log_info(f'Reading file {file_path}', file=file_path)
     try:
-        with open(file_path, 'r') as file_txt:
-            for line in file_txt:
-                line = line.strip()
-                get_data_from_text(line)
+        loop = asyncio.get_event_loop()
+        pool = get_process_pool()
+
+        # Resume from the last checkpoint, replaying an unconfirmed chunk as is
+        key = file_checkpoints.key_for(file_path)
+        state = file_checkpoints.load(key)
+        pending_chunk = state.get('pending')
+        if pending_chunk:
+            ranges = [(pending_chunk['start'], pending_chunk['end'])]
+            ranges += split_file_ranges(file_path, READ_CHUNK_SIZE, pending_chunk['end'])
+        else:
+            ranges = split_file_ranges(file_path, READ_CHUNK_SIZE, state['offset'])
+        if state['offset']:
+            log_info(f'Resuming {file_path} from byte {state["offset"]}', file=file_path)
+
+        async def commit(chunk_start: int, chunk_end: int, future: asyncio.Future) -> None:
+            matches, record_keys, links, chunk_version = await future
+            record_links(links, file_path)
+            # Dedup probing and the dist write stay off the event loop, in file order
+            await loop.run_in_executor(None, commit_chunk, key, chunk_start, chunk_end, matches, record_keys,
+                                       pending_chunk, chunk_version)
+
+        # Chunks ask for the rule set current when the file started; a pool process
+        # that reloads after a newer change uses that one, and chunks carry the version used
+        version = rule_sets.current().version
+
+        # Keep a bounded window of chunks in flight and write them in file order
+        window = max(PROCESS_POOL_WORKERS, 1) * 2
+        in_flight = []
+        for start, end in ranges:
+            in_flight.append((start, end, loop.run_in_executor(pool, match_file_range, file_path, start, end, version)))
+            if len(in_flight) >= window:
+                await commit(*in_flight.pop(0))
+        for chunk in in_flight:
+            await commit(*chunk)
+
+        file_checkpoints.clear(key)
         return file_path
+    except BrokenProcessPool as e:
+        # A worker died, start a fresh pool for the next file
+        global _process_pool
+        broken, _process_pool = _process_pool, None
+        if broken is not None:
+            broken.shutdown(wait=False)
+        log_error(f'Error indexing document: {e}', file=file_path)
+        return None
+    except Exception as e:
+        log_error(f'Error indexing document: {e}', file=file_path)
+        return None
+
+def free_space(path: str) -> Optional[int]:
+    """Free bytes on the volume holding path, None if it cannot be checked"""
+    try:
+        os.makedirs(path, exist_ok=True)
+        return shutil.disk_usage(path).free
     except Exception as e:
-        error_msg = f'Error indexing document: {e}'
-        print(error_msg)
+        log_error(f'Cannot check free space of {path}: {e}')
         return None
 
+def has_free_space(path: str, min_free: int, needed: int = 0) -> bool:
+    """Check that the volume holding path keeps min_free bytes after writing needed bytes"""
+    free = free_space(path)
+    return free is None or free - needed >= min_free
+
 def remove_file(file_path: str) -> None:
     """Remove file with error handling"""
     try:
         if os.path.exists(file_path):
             os.remove(file_path)
-            print(f'File {file_path} removed successfully.')
+            log_info(f'File {file_path} removed successfully.')
         else:
-            print(f'File {file_path} does not exist.')
+            log_info(f'File {file_path} does not exist.')
     except Exception as e:
-        error_msg = f'Error removing file: {str(e)}'
-        print(error_msg)
+        log_error(f'Error removing file: {str(e)}')
 
 def flatten_extracted_files(root_dir: str) -> List[str]:
     """Flatten directory structure after extraction"""
@@ -159,26 +1534,588 @@ def flatten_extracted_files(root_dir: str) -> List[str]:
 
     return extracted_files
 
-def extract_file(file_path: str, extension: str) -> Optional[str]:
-    """Extract archive files"""
+# Extraction workspaces
+WORKSPACE_PREFIX = 'job-'
+
+def create_workspace() -> str:
+    """Create a private scratch directory for one extraction job"""
+    os.makedirs(extract_dir, exist_ok=True)
+    return tempfile.mkdtemp(prefix=WORKSPACE_PREFIX, dir=extract_dir)
+
+def remove_workspace(workspace: str) -> None:
+    """Remove an extraction workspace and everything left in it"""
+    shutil.rmtree(workspace, ignore_errors=True)
+
+def is_workspace_file(file_path: str) -> bool:
+    """Check if file was extracted into a job workspace"""
+    workspace = os.path.dirname(os.path.abspath(file_path))
+    return (os.path.dirname(workspace) == os.path.abspath(extract_dir)
+            and os.path.basename(workspace).startswith(WORKSPACE_PREFIX))
+
+def release_workspace_file(file_path: str) -> None:
+    """Remove a processed workspace file and its workspace once empty"""
+    if not is_workspace_file(file_path):
+        return
+    if os.path.exists(file_path):
+        remove_file(file_path)
+    workspace = os.path.dirname(file_path)
+    try:
+        os.rmdir(workspace)
+    except OSError:
+        # Other members of the job are still pending
+        pass
+
+def extract_file(file_path: str, extension: str, destination: str = extract_dir) -> Optional[List[Tuple[str, str]]]:
+    """Extract archive files into destination, return the extracted files with their digests.
+
+    Digests are only added to the content index by the caller once a member
+    has been handed on, so a failure after extraction does not mark it seen.
+    """
     try:
+        kind = archive_kind(extension)
+        if kind in ('gz', 'bz2', 'xz') and archive_kind(file_path) == 'tar':
+            kind = 'tar'
         if extension == '.rar':
+            import rarfile  # type: ignore
             with rarfile.RarFile(file_path, 'r') as rar_ref:
-                rar_ref.extractall(extract_dir)
+                rar_ref.extractall(destination)
         elif extension == '.zip':
+            import pyzipper  # type: ignore
             with pyzipper.AESZipFile(file_path, 'r') as zip_ref:
-                zip_ref.extractall(extract_dir)
+                zip_ref.extractall(destination)
         elif extension == '.7z':
+            import py7zr  # type: ignore
             with py7zr.SevenZipFile(file_path, mode='r', password="") as archive:
-                archive.extractall(path=extract_dir)
+                archive.extractall(path=destination)
+        elif kind == 'tar':
+            import tarfile
+            with tarfile.open(file_path, 'r:*') as tar:
+                if hasattr(tarfile, 'data_filter'):
+                    tar.extractall(destination, filter='data')
+                else:
+                    tar.extractall(destination)
+        elif kind in ('gz', 'bz2', 'xz'):
+            import gzip
+            import bz2
+            import lzma
+            opener = {'gz': gzip.open, 'bz2': bz2.open, 'xz': lzma.open}[kind]
+            target = os.path.join(destination, os.path.splitext(os.path.basename(file_path))[0])
+            with opener(file_path, 'rb') as src, open(target, 'wb') as dst:
+                shutil.copyfileobj(src, dst, STREAM_READ_SIZE)
         else:
-            print(f'Unsupported file type: {extension}')
+            log_error(f'Unsupported file type: {extension}', file=file_path)
             return None
 
-        extract_file_tmp = flatten_extracted_files(extract_dir)
+        # Drop members whose content was already scanned
+        extracted_files = []
+        for extracted_file in flatten_extracted_files(destination):
+            digest, size = hash_file(extracted_file)
+            if content_index.seen(digest, size):
+                log_duplicate_content(extracted_file, size)
+                remove_file(extracted_file)
+            else:
+                extracted_files.append((extracted_file, digest))
+        return extracted_files
+
+    except Exception as e:
+        log_error(f'Error extracting file: {str(e)}', file=file_path)
+        return None
+
+# Streaming archive processing
+def iter_byte_lines(stream: IO[bytes], chunk_size: int = STREAM_READ_SIZE,
+                    on_block: Optional[Callable[[bytes], None]] = None) -> Iterator[bytes]:
+    """Yield raw lines of a binary stream using large reads, passing each block of whole lines to on_block"""
+    tail = b''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        block = tail + chunk
+        cut = block.rfind(b'\n') + 1
+        block, tail = block[:cut], block[cut:]
+        if on_block is not None and block:
+            on_block(block)
+        lines = block.split(b'\n')
+        lines.pop()
+        yield from lines
+    if tail:
+        if on_block is not None:
+            on_block(tail)
+        yield tail
+
+def scan_text_stream(stream: IO[bytes], source: str = '') -> int:
+    """Run the rule engine and link rules over a binary stream, return the number of matches"""
+    rule_set = rule_sets.current()
+    extractor = rule_set.extractor
+    links: List[Tuple[str, str]] = []
+    on_block = (lambda block: links.extend(extractor.find_bytes(block))) if extractor is not None else None
+    written = write_matches(rule_set.engine.match_byte_lines(iter_byte_lines(stream, on_block=on_block)),
+                            rule_set.version)
+    record_links(links, source)
+    return written
+
+# Spreadsheet ingestion
+TABULAR_FILE_TYPES = ['.csv', '.xlsx']
+ROW_BATCH_SIZE = 10000
+
+def iter_csv_rows(stream: IO[bytes], encoding: Optional[str] = None) -> Iterator[str]:
+    """Yield CSV records of a binary stream as rule engine lines, one record in memory at a time"""
+    import csv
+    csv.field_size_limit(STREAM_READ_SIZE * 16)
+    if needs_transcoding(encoding):
+        text = io.TextIOWrapper(stream, encoding=encoding, errors=DECODE_ERRORS, newline='')
+    else:
+        # Mixed dumps: UTF-8 where it decodes, DECODE_FALLBACK_ENCODING for the rest
+        text = io.TextIOWrapper(stream, encoding='utf-8-sig', errors='decode_fallback', newline='')
+    try:
+        for row in csv.reader(text):
+            cells = [cell.strip() for cell in row if cell.strip()]
+            if cells:
+                yield row_separator.join(cells)
+    finally:
+        text.detach()
+
+def iter_xlsx_rows(source) -> Iterator[str]:
+    """Yield worksheet rows as rule engine lines using openpyxl's read-only mode"""
+    import openpyxl  # type: ignore
+    workbook = openpyxl.load_workbook(source, read_only=True, data_only=True)
+    try:
+        for worksheet in workbook.worksheets:
+            for row in worksheet.iter_rows(values_only=True):
+                cells = [str(cell).strip() for cell in row if cell is not None and str(cell).strip()]
+                if cells:
+                    yield row_separator.join(cells)
+    finally:
+        workbook.close()
+
+def scan_rows(rows: Iterable[str], source: str) -> int:
+    """Run the rule engine and link rules over rows in batches, return the number of matches"""
+    rule_set = rule_sets.current()
+    extractor = rule_set.extractor
+    written = 0
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, ROW_BATCH_SIZE))
+        if not batch:
+            break
+        written += write_matches(rule_set.engine.match_lines(batch), rule_set.version)
+        if extractor is not None:
+            record_links(extractor.find_text('\n'.join(batch)), source)
+    return written
+
+def scan_table(source, extension: str, label: str, encoding: Optional[str] = None) -> int:
+    """Scan a CSV or XLSX file given as path or seekable binary stream, encoding as sniffed for CSV"""
+    if extension == '.xlsx':
+        return scan_rows(iter_xlsx_rows(source), label)
+    if isinstance(source, str):
+        with open(source, 'rb') as stream:
+            return scan_rows(iter_csv_rows(stream, encoding), label)
+    return scan_rows(iter_csv_rows(source, encoding), label)
+
+async def read_file_table(file_path: str, extension: Optional[str] = None,
+                          encoding: Optional[str] = None) -> Optional[str]:
+    """Read and process a spreadsheet in a worker thread, in constant memory"""
+    log_info(f'Reading file {file_path}', file=file_path)
+    try:
+        extension = extension or os.path.splitext(file_path)[1].lower()
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, scan_table, file_path, extension, file_path, encoding)
+        return file_path
+    except Exception as e:
+        log_error(f'Error indexing document: {e}', file=file_path)
+        return None
+
+def scan_transcoded_file(file_path: str, encoding: str) -> int:
+    """Scan a UTF-16/32 text file re-encoded as UTF-8"""
+    with open(file_path, 'rb') as f:
+        return scan_text_stream(TranscodingReader(f, encoding), file_path)
+
+async def read_file_transcoded(file_path: str, encoding: str) -> Optional[str]:
+    """Read and process a text file in a wide encoding in a worker thread"""
+    log_info(f'Reading file {file_path}', file=file_path, encoding=encoding)
+    try:
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, scan_transcoded_file, file_path, encoding)
+        return file_path
+    except Exception as e:
+        log_error(f'Error indexing document: {e}', file=file_path)
+        return None
+
+class ArchiveLimitError(Exception):
+    """An archive tree went over its depth, size, ratio or member limits"""
+
+class ArchiveBudget:
+    """Decompressed bytes and members one archive tree may still use"""
+
+    def __init__(self, max_total: int, max_members: int):
+        self.remaining = max_total
+        self.members_left = max_members
+        self.scanned = 0
+
+    def member(self, name: str) -> None:
+        self.members_left -= 1
+        if self.members_left < 0:
+            raise ArchiveLimitError(f'{name}: more than {archive_max_members} members')
+
+    def consume(self, size: int, name: str) -> None:
+        self.remaining -= size
+        if self.remaining < 0:
+            raise ArchiveLimitError(f'{name}: more than {archive_max_total_size} bytes unpacked')
+
+# Longest suffix first, compressed tars are read as one tar stream
+ARCHIVE_KINDS = [
+    ('.tar.gz', 'tar'), ('.tar.bz2', 'tar'), ('.tar.xz', 'tar'),
+    ('.tgz', 'tar'), ('.tbz2', 'tar'), ('.txz', 'tar'), ('.tar', 'tar'),
+    ('.zip', 'zip'), ('.rar', 'rar'), ('.7z', '7z'),
+    ('.gz', 'gz'), ('.bz2', 'bz2'), ('.xz', 'xz')
+]
+
+def archive_kind(name: str) -> Optional[str]:
+    """Archive format of a file name, None for anything else"""
+    lower = name.lower()
+    for suffix, kind in ARCHIVE_KINDS:
+        if lower.endswith(suffix):
+            return kind
+    return None
+
+# Content sniffing
+SNIFF_SIZE = 8192
+KIND_EXTENSIONS = {'zip': '.zip', 'rar': '.rar', '7z': '.7z', 'tar': '.tar', 'gz': '.gz', 'bz2': '.bz2', 'xz': '.xz'}
+MAGIC_NUMBERS = [
+    (b'PK\x03\x04', 'zip'), (b'PK\x05\x06', 'zip'),
+    (b'Rar!\x1a\x07', 'rar'), (b'7z\xbc\xaf\x27\x1c', '7z'),
+    (b'\x1f\x8b', 'gz'), (b'BZh', 'bz2'), (b'\xfd7zXZ\x00', 'xz')
+]
+BOMS = [
+    (b'\xff\xfe\x00\x00', 'utf-32'), (b'\x00\x00\xfe\xff', 'utf-32'),
+    (b'\xef\xbb\xbf', 'utf-8-sig'), (b'\xff\xfe', 'utf-16'), (b'\xfe\xff', 'utf-16')
+]
+# Bytes expected in text: printable ASCII, tab, newlines, form feed, backspace, escape and 8-bit
+_TEXT_BYTES = bytes({7, 8, 9, 10, 12, 13, 27} | set(range(0x20, 0x100)) - {0x7f})
+BINARY_CONTROL_RATIO = 0.1
+
+def _is_compressed_tar(head: bytes, kind: str) -> Optional[bool]:
+    """Check for a tar header behind gz/bz2/xz compression, None if the head is too short to tell"""
+    import bz2
+    import lzma
+    import zlib
+    try:
+        if kind == 'gz':
+            data = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(head, 512)
+        elif kind == 'bz2':
+            data = bz2.BZ2Decompressor().decompress(head, 512)
+        else:
+            data = lzma.LZMADecompressor().decompress(head, 512)
+    except Exception:
+        return None
+    if len(data) < 262:
+        return None
+    return data[257:262] == b'ustar'
+
+def classify_head(head: bytes, name: str = '') -> Tuple[str, Optional[str]]:
+    """Classify content from its first bytes.
+
+    Returns (kind, encoding): kind is an archive kind from ARCHIVE_KINDS,
+    'xlsx', 'text' or 'binary'; encoding is only set for text. The name is
+    only used to break ties the first bytes cannot settle.
+    """
+    for magic, kind in MAGIC_NUMBERS:
+        if head.startswith(magic):
+            if kind == 'zip' and (name.lower().endswith('.xlsx') or b'xl/' in head):
+                return 'xlsx', None
+            if kind in ('gz', 'bz2', 'xz'):
+                is_tar = _is_compressed_tar(head, kind)
+                if is_tar or (is_tar is None and archive_kind(name) == 'tar'):
+                    return 'tar', None
+            return kind, None
+    if head[257:262] == b'ustar':
+        return 'tar', None
+
+    for bom, encoding in BOMS:
+        if head.startswith(bom):
+            return 'text', encoding
+    if head:
+        # UTF-16 without BOM: every other byte is NUL in mostly ASCII text
+        even_nuls, odd_nuls = head[0::2].count(0), head[1::2].count(0)
+        if odd_nuls > len(head) * 0.4 and even_nuls == 0:
+            return 'text', 'utf-16-le'
+        if even_nuls > len(head) * 0.4 and odd_nuls == 0:
+            return 'text', 'utf-16-be'
+        if b'\x00' in head or len(head.translate(None, _TEXT_BYTES)) > len(head) * BINARY_CONTROL_RATIO:
+            return 'binary', None
+
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(head, final=False)
+        return 'text', 'utf-8'
+    except UnicodeDecodeError:
+        return 'text', DECODE_FALLBACK_ENCODING
+
+def sniff_file(file_path: str) -> Tuple[str, Optional[str]]:
+    """Classify a file from its first SNIFF_SIZE bytes"""
+    with open(file_path, 'rb') as f:
+        return classify_head(f.read(SNIFF_SIZE), file_path)
+
+def needs_transcoding(encoding: Optional[str]) -> bool:
+    """Byte level rules work on ASCII compatible encodings only"""
+    return bool(encoding) and encoding.replace('-', '').lower().startswith(('utf16', 'utf32'))
+
+class TranscodingReader:
+    """Binary reader that re-encodes a UTF-16/32 stream as UTF-8 for the byte level rules"""
+
+    def __init__(self, stream: IO[bytes], encoding: str):
+        self.stream = stream
+        self.decoder = codecs.getincrementaldecoder(encoding)(errors=DECODE_ERRORS)
+
+    def read(self, size: int = -1) -> bytes:
+        while True:
+            chunk = self.stream.read(size)
+            text = self.decoder.decode(chunk, final=not chunk)
+            if text or not chunk:
+                return text.encode('utf-8', errors='surrogateescape')
+
+def _check_ratio(name: str, size: int, compressed: int) -> None:
+    """Reject members that inflate like a zip bomb, small members are let through"""
+    if compressed and size > STREAM_READ_SIZE and size / compressed > archive_max_ratio:
+        raise ArchiveLimitError(f'{name}: compression ratio {size // compressed} over {archive_max_ratio}')
+
+def _iter_members(source: IO[bytes], kind: str, name: str,
+                  source_size: int) -> Iterator[Tuple[str, IO[bytes], int, int, Optional[Callable[[], IO[bytes]]]]]:
+    """Yield name, stream, sizes (0 when unknown) and, for formats with random access, a reopener of each file"""
+    if kind == 'zip':
+        import pyzipper  # type: ignore
+        with pyzipper.AESZipFile(source, 'r') as zip_ref:
+            for info in zip_ref.infolist():
+                if not info.is_dir():
+                    with zip_ref.open(info) as member:
+                        yield (info.filename, member, info.file_size, info.compress_size,
+                               lambda info=info: zip_ref.open(info))
+    elif kind == 'rar':
+        import rarfile  # type: ignore
+        with rarfile.RarFile(source, 'r') as rar_ref:
+            for info in rar_ref.infolist():
+                if not info.is_dir():
+                    with rar_ref.open(info) as member:
+                        yield (info.filename, member, info.file_size, info.compress_size,
+                               lambda info=info: rar_ref.open(info))
+    elif kind == '7z':
+        import py7zr  # type: ignore
+        # Solid blocks can only be decoded front to back, so the archive is
+        # unpacked once to a scratch directory and members are read from there
+        with py7zr.SevenZipFile(source, mode='r', password="") as archive, \
+                tempfile.TemporaryDirectory(dir=extract_dir) as scratch:
+            infos = [info for info in archive.list() if not info.is_directory]
+            unpacked = sum(info.uncompressed or 0 for info in infos)
+            _check_ratio(name, unpacked, source_size)
+            if unpacked > archive_max_total_size:
+                raise ArchiveLimitError(f'{name}: {unpacked} bytes unpacked over {archive_max_total_size}')
+            wait_for_free_space(extract_dir, extract_min_free, unpacked, name)
+            archive.extractall(path=scratch)
+            for info in infos:
+                path = os.path.join(scratch, info.filename)
+                if os.path.isfile(path) and not os.path.islink(path):
+                    with open(path, 'rb') as member:
+                        yield (info.filename, member, info.uncompressed, info.compressed or 0,
+                               lambda path=path: open(path, 'rb'))
+    elif kind == 'tar':
+        import tarfile
+        # Stream mode reads members in order, any compression is detected
+        with tarfile.open(fileobj=source, mode='r|*') as tar:
+            for info in tar:
+                if info.isfile():
+                    yield info.name, tar.extractfile(info), info.size, 0, None
+    else:
+        import gzip
+        import bz2
+        import lzma
+        opener = {'gz': gzip.open, 'bz2': bz2.open, 'xz': lzma.open}[kind]
+
+        def reopen() -> IO[bytes]:
+            source.seek(0)
+            return opener(source, 'rb')
+
+        with opener(source, 'rb') as member:
+            yield os.path.splitext(os.path.basename(name.rsplit(':', 1)[-1]))[0], member, 0, source_size, reopen
+
+class MemberReader(io.RawIOBase):
+    """Archive member stream that hashes, counts and budgets every byte read from it.
+
+    ``peek`` reads ahead into a buffer that later reads serve first, so a
+    member can be sniffed, and a small one checked against the content index,
+    before a handler consumes it as a plain stream.
+    """
+
+    def __init__(self, stream: IO[bytes], name: str, compressed: int, budget: ArchiveBudget):
+        self.stream = stream
+        self.name = name
+        self.compressed = compressed
+        self.budget = budget
+        self.sha = hashlib.sha256()
+        self.size = 0
+        self.eof = False
+        self._pending = b''
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def _fill(self, size: int) -> bytes:
+        chunk = self.stream.read(size)
+        if not chunk:
+            self.eof = True
+            return b''
+        self.size += len(chunk)
+        self.budget.consume(len(chunk), self.name)
+        # Declared sizes can lie, check the bytes actually produced
+        _check_ratio(self.name, self.size, self.compressed)
+        self.sha.update(chunk)
+        return chunk
+
+    def peek(self, limit: int) -> bytes:
+        """Return up to limit bytes from the current position without consuming them"""
+        parts = [self._pending[self._pos:]]
+        have = len(parts[0])
+        while have < limit and not self.eof:
+            chunk = self._fill(min(STREAM_READ_SIZE, limit - have))
+            parts.append(chunk)
+            have += len(chunk)
+        self._pending, self._pos = b''.join(parts), 0
+        return self._pending[:limit]
+
+    def readinto(self, buffer) -> int:
+        if self._pos < len(self._pending):
+            n = min(len(buffer), len(self._pending) - self._pos)
+            buffer[:n] = memoryview(self._pending)[self._pos:self._pos + n]
+            self._pos += n
+            return n
+        chunk = self._fill(len(buffer))
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+    def digest(self) -> str:
+        """SHA-256 of the whole member; what no handler read yet is hashed and dropped"""
+        while not self.eof:
+            self._fill(STREAM_READ_SIZE)
+        return self.sha.hexdigest()
+
+def wait_for_free_space(path: str, min_free: int, needed: int, name: str) -> None:
+    """Block the calling worker thread while the volume would fall under its watermark"""
+    if has_free_space(path, min_free, needed):
+        return
+    log_info(f'Unpacking {name} deferred, low free space in {path}', file=name)
+    while not has_free_space(path, min_free, needed):
+        time.sleep(disk_check_interval)
+
+def _spool(reader: MemberReader) -> IO[bytes]:
+    """Copy a member to a spooled temp file for handlers that need to seek"""
+    spool = tempfile.SpooledTemporaryFile(max_size=nested_spool_size, dir=extract_dir)
+    size = 0
+    next_check = nested_spool_size
+    try:
+        while True:
+            chunk = reader.read(STREAM_READ_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            # Past the in-memory size the spool is on disk, keep the extract volume's watermark
+            if size > next_check:
+                wait_for_free_space(extract_dir, extract_min_free, nested_spool_size, reader.name)
+                next_check += nested_spool_size
+            spool.write(chunk)
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
+
+def _scan_member(stream: IO[bytes], kind: str, encoding: Optional[str], extension: str, label: str) -> None:
+    """Run the text or CSV handler over a member stream"""
+    if kind == 'text' and extension == '.csv':
+        scan_table(stream, '.csv', label, encoding)
+    else:
+        scan_text_stream(TranscodingReader(stream, encoding) if needs_transcoding(encoding) else stream, label)
+
+def _stream_tree(source: IO[bytes], kind: str, name: str, source_size: int, depth: int, budget: ArchiveBudget) -> None:
+    """Scan text and spreadsheet members of an archive, unpacking nested archives in process"""
+    for member_name, member, size, compressed, reopen in _iter_members(source, kind, name, source_size):
+        label = f'{name}:{member_name}'
+        budget.member(label)
+        member_extension = os.path.splitext(member_name)[1].lower()
+        reader = MemberReader(member, label, compressed, budget)
+
+        # Pick the handler from the first bytes, whatever the member is called
+        member_kind, encoding = classify_head(reader.peek(SNIFF_SIZE), member_name)
+        if member_kind == 'binary':
+            continue
+        if member_kind in KIND_EXTENSIONS and depth >= nested_max_depth:
+            log_error(f'Skipping {label}: nested deeper than {nested_max_depth} levels', file=name)
+            continue
+        _check_ratio(label, size, compressed)
+
+        if member_kind == 'text':
+            # Text is scanned straight from the archive, never spooled. A member that
+            # fits in memory is hashed from its buffer; a larger one is hashed by a
+            # decompress-only pass and reopened for the scan when the format allows,
+            # otherwise it can only be hashed while it is scanned
+            reader.peek(nested_spool_size)
+            buffered = reader.eof
+            if buffered or reopen is not None:
+                digest = reader.digest()
+                if content_index.seen(digest, reader.size):
+                    log_duplicate_content(label, reader.size)
+                    continue
+            budget.scanned += 1
+            if buffered or reopen is None:
+                _scan_member(io.BufferedReader(reader, STREAM_READ_SIZE), member_kind, encoding, member_extension, label)
+            else:
+                with reopen() as again:
+                    _scan_member(again, member_kind, encoding, member_extension, label)
+            digest = reader.digest()
+        else:
+            # Spreadsheets and nested archives need a seekable file
+            with _spool(reader) as spool:
+                digest = reader.digest()
+                if content_index.seen(digest, reader.size):
+                    log_duplicate_content(label, reader.size)
+                    continue
+                if member_kind == 'xlsx':
+                    budget.scanned += 1
+                    scan_table(spool, '.xlsx', label)
+                else:
+                    _stream_tree(spool, member_kind, label, reader.size, depth + 1, budget)
+        # Only fully scanned content counts as seen, a failure leaves it to the retry
+        content_index.add(digest)
+
+def stream_archive(file_path: str, extension: str, kind: Optional[str] = None) -> Optional[str]:
+    """Scan text and spreadsheet members of an archive tree in place, without extracting to disk.
+
+    Nested archives are unpacked recursively up to NESTED_MAX_DEPTH levels
+    through spooled temp files; 7z archives are unpacked once to a scratch
+    directory in EXTRACT_DIR, as their solid blocks only decode front to
+    back. The whole tree shares one budget of
+    ARCHIVE_MAX_TOTAL_SIZE unpacked bytes and ARCHIVE_MAX_MEMBERS members,
+    and members inflating beyond ARCHIVE_MAX_RATIO abort it as a likely zip
+    bomb; what was scanned until then is kept. Returns None when the format
+    is unsupported or reading fails before any member was scanned, so the
+    caller can fall back to extract_file; once matches may have been written
+    a failure ends the archive instead, as falling back would write them
+    again. A sniffed kind takes precedence over the name.
+    """
+    kind = kind or archive_kind(file_path) or archive_kind(extension)
+    if kind is None:
+        return None
+    budget = ArchiveBudget(archive_max_total_size, archive_max_members)
+    try:
+        os.makedirs(extract_dir, exist_ok=True)
+        with open(file_path, 'rb') as source:
+            _stream_tree(source, kind, file_path, os.path.getsize(file_path), 1, budget)
         return file_path
 
+    except ArchiveLimitError as e:
+        log_error(f'Stopped unpacking {file_path}: {e}', file=file_path)
+        return file_path
     except Exception as e:
-        error_msg = f'Error extracting file: {str(e)}'
-        print(error_msg)
+        log_error(f'Error streaming archive {file_path}: {str(e)}', file=file_path)
+        if budget.scanned:
+            log_error(f'Finished {file_path} with errors after {budget.scanned} members', file=file_path)
+            return file_path
         return None